@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+
+import argparse
+import base64
+import gzip
+import hashlib
+import http.server
+import json
+import logging
+import os
+import os.path
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+
+__version__ = '1.02'
+
+USERNAME = 'bench'
+PASSWORD = 'bench'
+
+
+class FakeAnytask:
+    def __init__(self):
+        self._courses = {}
+        self._requests = 0
+        self._lock = threading.Lock()
+        self._server = None
+
+    def set_course(self, course_id, document):
+        body = json.dumps(document).encode('utf8')
+        with self._lock:
+            self._courses[str(course_id)] = (
+                body, '"{}"'.format(hashlib.sha1(body).hexdigest()))
+
+    @property
+    def requests(self):
+        return self._requests
+
+    def reset_requests(self):
+        with self._lock:
+            self._requests = 0
+
+    def _handler(self):
+        anytask = self
+        authorization = 'Basic ' + base64.b64encode(
+            ':'.join([USERNAME, PASSWORD]).encode('utf8')).decode('ascii')
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _reply(self, code, body=b'', headers=()):
+                self.send_response(code)
+                for (key, value) in headers:
+                    self.send_header(key, value)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                with anytask._lock:
+                    anytask._requests += 1
+
+                if self.headers.get('Authorization') != authorization:
+                    self._reply(401, headers=[
+                        ('WWW-Authenticate', 'Basic realm="anytask"')])
+                    return
+
+                path = urllib.parse.urlsplit(self.path).path
+                course_id = path.rstrip('/').split('/')[-1]
+
+                with anytask._lock:
+                    course = anytask._courses.get(course_id)
+
+                if course is None:
+                    self._reply(404)
+                    return
+
+                (body, etag) = course
+                if self.headers.get('If-None-Match') == etag:
+                    self._reply(304, headers=[('ETag', etag)])
+                    return
+
+                headers = [('ETag', etag),
+                    ('Content-Type', 'application/json')]
+                if 'gzip' in self.headers.get('Accept-Encoding', ''):
+                    body = gzip.compress(body)
+                    headers.append(('Content-Encoding', 'gzip'))
+
+                self._reply(200, body, headers)
+
+            def log_message(self, format, *args):
+                logging.debug(format, *args)
+
+        return Handler
+
+    def start(self):
+        self._server = http.server.ThreadingHTTPServer(
+            ('127.0.0.1', 0), self._handler())
+        threading.Thread(
+            target=self._server.serve_forever, daemon=True).start()
+
+        return 'http://127.0.0.1:{}/'.format(self._server.server_port)
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class BenchRepositories:
+    def __init__(self, directory, files, size):
+        self._directory = directory
+        self._files = files
+        self._size = size
+        self._revisions = {}
+
+    def url(self, login='', path=''):
+        return '/'.join([
+            'file://' + urllib.parse.quote(
+                os.path.abspath(self._directory).replace('\\', '/')),
+            login, path]).rstrip('/')
+
+    @staticmethod
+    def _call(*args):
+        subprocess.check_call(args,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    def _fill(self, path, seed):
+        os.makedirs(path, exist_ok=True)
+        for index in range(self._files):
+            with open(os.path.join(path, 'file{}.py'.format(index)),
+                    mode='w') as f:
+                line = '# {} {}\n'.format(seed, index)
+                f.write(line * max(1, self._size // len(line)))
+
+    def create(self, login, tasks):
+        repo = os.path.join(self._directory, login)
+        self._call('svnadmin', 'create', repo)
+
+        with tempfile.TemporaryDirectory() as tree:
+            for task in tasks:
+                self._fill(os.path.join(tree, 'trunk', task), login)
+            os.makedirs(os.path.join(tree, 'branches'))
+            os.makedirs(os.path.join(tree, 'tags'))
+
+            self._call('svn', 'import', '--quiet', '-m', 'initial',
+                tree, self.url(login))
+
+        self._revisions[login] = 1
+        return 1
+
+    def change(self, login, task):
+        with tempfile.TemporaryDirectory() as tree:
+            changed = os.path.join(tree, 'changed.py')
+            with open(changed, mode='w') as f:
+                f.write('# {} {}\n'.format(login, self._revisions[login]))
+
+            self._call('svn', 'import', '--quiet', '-m', 'change',
+                changed, self.url(login, '/'.join(['trunk', task,
+                    'changed{}.py'.format(self._revisions[login])])))
+
+        self._revisions[login] += 1
+        return self._revisions[login]
+
+
+class BenchSvnserve:
+    def __init__(self, directory):
+        self._directory = directory
+        self._process = None
+
+    def start(self):
+        with socket.socket() as s:
+            s.bind(('127.0.0.1', 0))
+            port = s.getsockname()[1]
+
+        self._process = subprocess.Popen([
+            'svnserve', '--daemon', '--foreground',
+            '--listen-host', '127.0.0.1', '--listen-port', str(port),
+            '--root', os.path.abspath(self._directory)])
+        time.sleep(0.5)
+
+        return 'svn://127.0.0.1:{}/'.format(port)
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.wait()
+
+
+class BenchCourses:
+    def __init__(self, args, repositories):
+        self._args = args
+        self._repositories = repositories
+        self._documents = {}
+        self._solutions = []
+
+    @staticmethod
+    def _task_path(course, index):
+        return 'task{}_{}'.format(course, index)
+
+    def _students(self):
+        return ['student{:04d}'.format(index)
+            for index in range(self._args.students)]
+
+    def generate(self):
+        course_ids = range(1, self._args.courses + 1)
+        logins = self._students()
+        paths = [self._task_path(course, task)
+            for course in course_ids for task in range(self._args.tasks)]
+        unlinked = (round(1 / self._args.unlinked)
+            if self._args.unlinked > 0 else 0)
+
+        revisions = {}
+        for login in logins:
+            revisions[login] = self._repositories.create(login, paths)
+
+        review_id = 1
+        for course in course_ids:
+            tasks = []
+            parent = None
+
+            for level in range(self._args.depth - 1):
+                task_id = course * 100000 + level
+                tasks.append({
+                    'task_id': task_id, 'parent_task_id': parent,
+                    'title': 'Level {}'.format(level), 'students': []})
+                parent = task_id
+
+            for task in range(self._args.tasks):
+                students = []
+                for (index, login) in enumerate(logins):
+                    linked = not unlinked or (
+                        index % unlinked != unlinked - 1)
+                    svn = {
+                        'svn_path': ('trunk/' + self._task_path(course, task)
+                            if linked else ''),
+                        'rb_review_id': review_id,
+                        'svn_rev': revisions[login]}
+                    students.append({
+                        'user_name': 'Student {}'.format(login),
+                        'username': login,
+                        'svn': svn})
+                    self._solutions.append(
+                        (course, self._task_path(course, task), login, svn))
+                    review_id += 1
+
+                tasks.append({
+                    'task_id': course * 100000 + 1000 + task,
+                    'parent_task_id': parent,
+                    'title': 'Task {}'.format(task),
+                    'students': students})
+
+            self._documents[course] = {'tasks': tasks}
+
+        return self._documents
+
+    def change(self, count):
+        changed = set(self._students()[:count])
+
+        for (course, task, login, svn) in self._solutions:
+            if login in changed and svn['svn_path']:
+                svn['svn_rev'] = self._repositories.change(login, task)
+
+        return self._documents
+
+
+class Bench:
+    def __init__(self, args):
+        self._args = args
+        self._workdir = os.path.abspath(args.workdir or
+            tempfile.mkdtemp(prefix='anybench-'))
+        self._anytask = FakeAnytask()
+        self._repositories = BenchRepositories(
+            os.path.join(self._workdir, 'repos'), args.files, args.file_size)
+        self._courses = BenchCourses(args, self._repositories)
+        self._svnserve = None
+        self._results = []
+
+    def _publish(self, documents):
+        for (course, document) in documents.items():
+            self._anytask.set_course(course, document)
+
+    def _write_config(self, mainurl, svnurl):
+        config = os.path.join(self._workdir, 'bench.conf')
+        with open(config, mode='w') as f:
+            f.write('\n'.join([
+                '[AUTH]',
+                'anytaskurl = ' + mainurl,
+                'username = ' + USERNAME,
+                'password = ' + PASSWORD,
+                '',
+                '[COURSE]',
+                'name = course',
+                'unsorted = etc',
+                'svn = ' + svnurl,
+                'ids = ' + ','.join(
+                    str(course) for course in range(
+                        1, self._args.courses + 1)),
+                'ignore = ',
+                'cache = ' + os.path.join(self._workdir, 'cache'),
+                '',
+                '[RB_LINKS]',
+                '',
+                '[RELOCS]',
+                '']))
+
+        return config
+
+    @staticmethod
+    def _load_metrics(filename):
+        try:
+            with open(filename, encoding='utf8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logging.warning("Can't load metrics '%s'.\n%s", filename, e)
+            return {}
+
+    def _run(self, name, config, *options):
+        metrics = os.path.join(self._workdir, 'metrics-{}.json'.format(name))
+        callargs = [sys.executable, self._args.anysync,
+            '--config=' + config, '-q', '-Q',
+            '--jobs', str(self._args.jobs),
+            '--metrics=' + metrics] + list(options)
+
+        logging.info("Running scenario '%s'", name)
+        self._anytask.reset_requests()
+
+        start = time.perf_counter()
+        with open(os.devnull, mode='w') as devnull:
+            code = subprocess.call(callargs,
+                cwd=os.path.join(self._workdir, 'sync'),
+                stdout=devnull, stdin=subprocess.DEVNULL)
+        wall = time.perf_counter() - start
+
+        # Phases show which stage of the synchronizer has regressed
+        report = self._load_metrics(metrics)
+        solutions = report.get('solutions', [])
+
+        self._results.append({
+            'scenario': name,
+            'options': list(options),
+            'returncode': code,
+            'wall_time': round(wall, 4),
+            'api_requests': self._anytask.requests,
+            'phases': report.get('phases', {}),
+            'counters': report.get('counters', {}),
+            'checkouts': len(solutions),
+            'checkout_time': round(
+                sum(item['seconds'] for item in solutions), 4)})
+
+        logging.info("Scenario '%s' took %.2fs", name, wall)
+
+    def run(self):
+        logging.info("Working directory '%s'", self._workdir)
+        os.makedirs(os.path.join(self._workdir, 'sync'), exist_ok=True)
+
+        start = time.perf_counter()
+        self._publish(self._courses.generate())
+        setup = time.perf_counter() - start
+
+        mainurl = self._anytask.start()
+        svnurl = self._repositories.url() + '/'
+        if self._args.svnserve:
+            self._svnserve = BenchSvnserve(
+                os.path.join(self._workdir, 'repos'))
+            svnurl = self._svnserve.start()
+
+        try:
+            config = self._write_config(mainurl, svnurl)
+
+            self._run('cold', config)
+            self._run('update-info', config, '-U')
+
+            self._publish(self._courses.change(self._args.changed))
+            self._run('update', config, '-u')
+
+            self._run('student', config, '-s', 'student0000')
+            self._run('task', config, '-t', 'Task 0')
+            self._run('force', config, '-f')
+        finally:
+            self._anytask.stop()
+            if self._svnserve is not None:
+                self._svnserve.stop()
+
+        return {
+            'version': __version__,
+            'parameters': {
+                'courses': self._args.courses,
+                'depth': self._args.depth,
+                'tasks': self._args.tasks,
+                'students': self._args.students,
+                'files': self._args.files,
+                'file_size': self._args.file_size,
+                'unlinked': self._args.unlinked,
+                'changed': self._args.changed,
+                'jobs': self._args.jobs,
+                'transport': 'svnserve' if self._args.svnserve else 'file'},
+            'setup_time': round(setup, 4),
+            'scenarios': self._results}
+
+    def cleanup(self):
+        if not self._args.keep:
+            shutil.rmtree(self._workdir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        usage='%(prog)s [OPTIONS]',
+        description='AnyTask SVN Synchronizer benchmark')
+    parser.add_argument(
+        '--anysync',
+        metavar='FILENAME',
+        default=os.path.join(
+            os.path.dirname(os.path.abspath(__file__)), 'anysync.py'),
+        help='synchronizer to measure')
+    parser.add_argument(
+        '--courses',
+        metavar='N', type=int, default=2, help='number of courses')
+    parser.add_argument(
+        '--depth',
+        metavar='N', type=int, default=2, help='depth of the task tree')
+    parser.add_argument(
+        '--tasks',
+        metavar='N', type=int, default=5, help='tasks per course')
+    parser.add_argument(
+        '--students',
+        metavar='N', type=int, default=20, help='number of students')
+    parser.add_argument(
+        '--files',
+        metavar='N', type=int, default=5, help='files per task')
+    parser.add_argument(
+        '--file-size',
+        metavar='BYTES', type=int, default=2048, help='size of each file')
+    parser.add_argument(
+        '--unlinked',
+        metavar='FRACTION', type=float, default=0.1,
+        help='fraction of solutions without `svn_path`')
+    parser.add_argument(
+        '--changed',
+        metavar='N', type=int, default=3,
+        help='students changed before the update scenario')
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='N', type=int, default=1, help='parallel downloads')
+    parser.add_argument(
+        '--svnserve',
+        action='store_true', help='serve repositories with svnserve')
+    parser.add_argument(
+        '--workdir',
+        metavar='DIR', help='working directory (temporary by default)')
+    parser.add_argument(
+        '--keep',
+        action='store_true', help='keep working directory')
+    parser.add_argument(
+        '-o', '--output',
+        metavar='FILENAME', help='write results to file')
+    parser.add_argument(
+        '-v', '--verbose',
+        action='store_true', help='print verbose information')
+    args = parser.parse_args()
+
+    logging.basicConfig(format='[%(levelname)s] %(message)s',
+        level=logging.INFO if args.verbose else logging.WARNING)
+
+    for tool in ['svn', 'svnadmin'] + (['svnserve'] if args.svnserve else []):
+        if shutil.which(tool) is None:
+            parser.error("'{}' is required".format(tool))
+
+    bench = Bench(args)
+    try:
+        results = bench.run()
+    finally:
+        bench.cleanup()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, mode='w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,26 +1,94 @@
 #!/usr/bin/env python3
 
 import argparse
+import base64
+import collections
+import concurrent.futures
 import configparser
+import contextlib
+import fnmatch
+import gzip
+import hashlib
+import heapq
+import http.client
+import itertools
 import json
 import logging
 import os
 import os.path
+import queue
+import random
+import re
+import shutil
+import signal
+import stat
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.error
 import urllib.parse
 import urllib.request
-import xml.dom.minidom
+import xml.etree.ElementTree
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt
 
 
 __version__ = '1.02'
 
+# Keep the svn command line well below the Windows limit of 32767 chars
+SVN_ARGV_LIMIT = 24000
+
+# Parallel keep-alive connections used to load courses
+HTTP_CONNECTIONS = 4
+HTTP_MAX_REDIRECTS = 5
+
+# Longest pause between watch cycles after server errors
+WATCH_MAX_BACKOFF = 3600
+
+# Failed downloads are retried after a jittered exponential pause
+RETRY_DELAY = 2
+RETRY_MAX_DELAY = 60
+
+# A download this many times slower than usual halves the concurrency
+SVN_SLOW_FACTOR = 4
+
+# Local `svn info` on working copies never needs the network
+SVN_INFO_TIMEOUT = 300
+
+# svn errors of an unreachable or refusing server, as opposed to errors
+# of a single solution such as a missing path: authorization, connection,
+# name resolution and socket errors
+SVN_HOST_ERRORS = re.compile(
+    rb'svn: E(170001|170013|175002|175012|215004|67\d{4}|73\d{4}|'
+    rb'0001(04|10|11|13)):')
+
+# Courses waiting between pipeline stages, and how often downloads
+# check for newly selected solutions
+PIPELINE_QUEUE = 4
+PIPELINE_POLL = 0.1
+
+# Stages of the course model, each built only when first needed
+STAGE_TASKS = 1
+STAGE_STUDENTS = 2
+STAGE_SOLUTIONS = 3
+
+# Synchronizer state kept inside the course directory
+STATE_DIR = '.anysync'
+
 
 class AnytaskTask:
+    __slots__ = ('_course', '_title', '_name')
+
     def __init__(self, course, title, name):
-        self._course = course
-        self._title = title
-        self._name = name
+        self._course = sys.intern(course)
+        self._title = sys.intern(title)
+        self._name = sys.intern(name)
 
     @property
     def course_id(self):
@@ -36,6 +104,8 @@ class AnytaskTask:
 
 
 class AnytaskStudent:
+    __slots__ = ('_fullname', '_username')
+
     def __init__(self, fullname, username):
         self._fullname = fullname
         self._username = username
@@ -50,13 +120,22 @@ class AnytaskStudent:
 
 
 class AnytaskSVN:
+    __slots__ = ('_path', '_reviewid', '_revision')
+
     def __init__(self, path, review_id, revision):
         self._path = path
-        self._reviewid = str(review_id)
-        self._revision = str(revision)
+        self._reviewid = AnytaskSVN._number(review_id)
+        self._revision = AnytaskSVN._number(revision)
 
         if self._path is not None:
-            self._path = self._path.strip()
+            self._path = sys.intern(self._path.strip())
+
+    @staticmethod
+    def _number(value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return str(value)
 
     @property
     def path(self):
@@ -64,14 +143,16 @@ class AnytaskSVN:
 
     @property
     def review_id(self):
-        return self._reviewid
+        return str(self._reviewid)
 
     @property
     def revision(self):
-        return self._revision
+        return str(self._revision)
 
 
 class AnytaskSolution:
+    __slots__ = ('_task', '_student', '_svn')
+
     def __init__(self, task, student):
         self._task = task
         self._student = student
@@ -93,11 +174,41 @@ class AnytaskSolution:
         return self._svn
 
 
+class AnytaskIndex:
+    def __init__(self):
+        self._keys = {
+            'course': {}, 'task': {}, 'student': {}, 'review': {}}
+
+    def _add(self, dimension, key, position):
+        self._keys[dimension].setdefault(key, set()).add(position)
+
+    def add(self, position, solution):
+        self._add('course', solution.task.course_id, position)
+        self._add('task', solution.task.name, position)
+        self._add('task', solution.task.title, position)
+        self._add('student', solution.student.name, position)
+        self._add('student', solution.student.repo, position)
+
+        if solution.svn is not None:
+            self._add('review', solution.svn.review_id, position)
+
+    def lookup(self, dimension, keys):
+        index = self._keys[dimension]
+        result = set()
+
+        for key in keys:
+            result |= index.get(key, set())
+
+        return result
+
+
 class AnytaskConfig:
     def __init__(self, filename):
         self._filename = filename
-        self._config = configparser.ConfigParser()
-        self._config.optionxform = str
+        self._config = AnytaskConfig._parser()
+        self._changes = []
+        self._depth = 0
+        self._lock = threading.RLock()
 
         logging.info("Loading configuration from '%s'", filename)
 
@@ -123,6 +234,17 @@ class AnytaskConfig:
                 logging.critical("Invalid config file: no '%s' option", option)
                 raise ConfigParseError()
 
+        for option in ['cache_ttl', 'connect_timeout', 'read_timeout',
+                'svn_timeout', 'svn_stall_timeout', 'svn_max_failures',
+                'max_file_size']:
+            try:
+                if getattr(self, option) < 0:
+                    raise ValueError(option)
+            except ValueError:
+                logging.critical("Invalid config file: bad '%s' option",
+                    option)
+                raise ConfigParseError()
+
         for section in ['RB_LINKS', 'RELOCS']:
             try:
                 if not self._config.has_section(section):
@@ -133,9 +255,97 @@ class AnytaskConfig:
 
         logging.info("Configuration loaded")
 
+    @staticmethod
+    def _parser():
+        config = configparser.ConfigParser()
+        config.optionxform = str
+        return config
+
+    @staticmethod
+    def _split(value):
+        return set(
+            filter(lambda s: s,
+                map(lambda s: s.strip(), value.split(','))))
+
+    @staticmethod
+    def _apply(config, change):
+        (action, section, key, value) = change
+
+        if action == 'set':
+            if not config.has_section(section):
+                config.add_section(section)
+            config.set(section, key, value)
+        elif action == 'remove':
+            if config.has_section(section):
+                config.remove_option(section, key)
+        else:
+            igns = AnytaskConfig._split(config[section][key])
+            if action == 'ignore':
+                igns.add(value)
+            else:
+                igns.discard(value)
+            config.set(section, key, ','.join(sorted(igns)))
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with open(self._filename + '.lock', mode='a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            else:
+                msvcrt.locking(lock.fileno(), msvcrt.LK_LOCK, 1)
+
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+                else:
+                    lock.seek(0)
+                    msvcrt.locking(lock.fileno(), msvcrt.LK_UNLCK, 1)
+
     def _save(self):
-        with open(self._filename, mode='w') as f:
-            self._config.write(f, True)
+        if self._depth == 0:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            if not self._changes:
+                return
+
+            # Changes are replayed over the current file, so concurrent
+            # runs never overwrite each other's links and ignores
+            with self._locked():
+                config = AnytaskConfig._parser()
+                if config.read(self._filename) == []:
+                    raise OSError("Can't reload '{}'".format(self._filename))
+
+                for change in self._changes:
+                    AnytaskConfig._apply(config, change)
+
+                with open(self._filename + '.tmp', mode='w') as f:
+                    config.write(f, True)
+                os.replace(self._filename + '.tmp', self._filename)
+
+            logging.info("Configuration saved, %s changes",
+                len(self._changes))
+            self._config = config
+            self._changes = []
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self._lock:
+            self._depth += 1
+
+        try:
+            yield self
+        finally:
+            with self._lock:
+                self._depth -= 1
+                if self._depth == 0:
+                    try:
+                        self.flush()
+                    except Exception as e:
+                        logging.error("Failed to save configuration.\n%s", e)
 
     @property
     def _sect_auth(self):
@@ -175,20 +385,68 @@ class AnytaskConfig:
 
     @property
     def ignore(self):
-        return set(
-            filter(lambda s: s,
-                map(lambda s: s.strip(),
-                    self._sect_course['ignore'].split(','))))
+        return AnytaskConfig._split(self._sect_course['ignore'])
 
-    def _add_optval(self, optname, hname, keyval):
+    @property
+    def cache_dir(self):
+        default = os.path.join(
+            os.environ.get('XDG_CACHE_HOME') or
+                os.path.join(os.path.expanduser('~'), '.cache'),
+            'anysync')
+        return self._sect_course.get('cache', '').strip() or default
+
+    @property
+    def cache_ttl(self):
+        return int(self._sect_course.get('cache_ttl', '').strip() or 0)
+
+    @property
+    def connect_timeout(self):
+        return float(self._sect_auth.get('connect_timeout', '').strip() or 10)
+
+    @property
+    def read_timeout(self):
+        return float(self._sect_auth.get('read_timeout', '').strip() or 60)
+
+    @property
+    def svn_timeout(self):
+        return int(self._sect_course.get('svn_timeout', '').strip() or 3600)
+
+    @property
+    def svn_stall_timeout(self):
+        return int(
+            self._sect_course.get('svn_stall_timeout', '').strip() or 600)
+
+    @property
+    def svn_max_failures(self):
+        return int(self._sect_course.get('svn_max_failures', '').strip() or 5)
+
+    @property
+    def only(self):
+        return AnytaskConfig._split(self._sect_course.get('only', ''))
+
+    @property
+    def exclude(self):
+        return AnytaskConfig._split(self._sect_course.get('exclude', ''))
+
+    @property
+    def max_file_size(self):
+        return int(self._sect_course.get('max_file_size', '').strip() or 0)
+
+    def _change(self, change, message, hname):
         try:
-            self._config.set(optname, *keyval)
-            self._save()
+            with self._lock:
+                AnytaskConfig._apply(self._config, change)
+                self._changes.append(change)
+                self._save()
             return True
         except Exception as e:
-            logging.error("Failed to add %s.\n%s", hname, e)
+            logging.error(message, hname, e)
             return False
 
+    def _add_optval(self, optname, hname, keyval):
+        return self._change(('set', optname) + tuple(keyval),
+            "Failed to add %s.\n%s", hname)
+
     def _get_optval(self, optname, key):
         if self._config.has_option(optname, key):
             return self._config[optname][key]
@@ -196,13 +454,8 @@ class AnytaskConfig:
         return None
 
     def _remove_optval(self, optname, hname, key):
-        try:
-            self._config.remove_option(optname, key)
-            self._save()
-            return True
-        except Exception as e:
-            logging.error("Failed to remove %s.\n%s", hname, e)
-            return False
+        return self._change(('remove', optname, key, None),
+            "Failed to remove %s.\n%s", hname)
 
     def add_reloc(self, link):
         return self._add_optval('RELOCS', 'relocation', link)
@@ -223,440 +476,2685 @@ class AnytaskConfig:
         return self._remove_optval('RB_LINKS', 'link', link)
 
     def add_ignore(self, rb_id):
-        igns = self.ignore
-        if rb_id in igns:
+        if rb_id in self.ignore:
             return True
 
-        igns.add(rb_id)
-        return self._add_optval('COURSE', 'ignore', ('ignore', ','.join(igns)))
+        return self._change(('ignore', 'COURSE', 'ignore', rb_id),
+            "Failed to add %s.\n%s", 'ignore')
 
     def remove_ignore(self, rb_id):
-        igns = self.ignore
-        if rb_id not in igns:
+        if rb_id not in self.ignore:
             return True
 
-        igns.remove(rb_id)
-        return self._add_optval('COURSE', 'ignore', ('ignore', ','.join(igns)))
-
+        return self._change(('unignore', 'COURSE', 'ignore', rb_id),
+            "Failed to remove %s.\n%s", 'ignore')
 
-class ConfigParseError(Exception):
-    pass
 
+class AnytaskManifest:
+    def __init__(self, directory, suffix=''):
+        self._directory = directory
+        self._filename = os.path.join(directory, STATE_DIR,
+            'manifest' + suffix + '.json')
+        self._entries = self._load(self._filename)
+        self._merged = []
+        self._lock = threading.Lock()
 
-class AnytaskParseError(Exception):
-    pass
-
+        if suffix:
+            return
 
-class Anytask:
-    def _setup_auth(self):
-        logging.info("Prepare BasicHTTP authorization")
+        # Manifests written by shards are merged into the main one
+        for name in sorted(os.listdir(os.path.dirname(self._filename))
+                if os.path.isdir(os.path.dirname(self._filename)) else []):
+            if name.startswith('manifest.shard-') and name.endswith('.json'):
+                filename = os.path.join(os.path.dirname(self._filename), name)
+                for (key, entry) in self._load(filename).items():
+                    if entry.get('time', 0) >= (
+                            self._entries.get(key, {}).get('time', 0)):
+                        self._entries[key] = entry
+                self._merged.append(filename)
 
-        pass_mgr = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-        pass_mgr.add_password(None,
-            self._config.mainurl, self._config.username, self._config.password)
+    @staticmethod
+    def _load(filename):
+        try:
+            with open(filename, encoding='utf8') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning("Can't load manifest '%s'.\n%s", filename, e)
 
-        urllib.request.install_opener(
-            urllib.request.build_opener(
-                urllib.request.HTTPBasicAuthHandler(pass_mgr)))
+        return {}
 
-        logging.info("BasicHTTP authorization ready")
+    def _key(self, destination):
+        return os.path.relpath(destination, self._directory).replace('\\', '/')
 
-    def _load_courses(self):
-        self._courses = []
+    def get(self, destination):
+        entry = self._entries.get(self._key(destination))
+        if (entry is None) or entry.get('stale'):
+            return None
 
-        for course in self._config.courses_id:
-            logging.info("Loading course #%s", course)
+        return entry
+
+    def record(self, destination, url, revision, review_id, exported=False,
+            filtered=False):
+        with self._lock:
+            self._entries[self._key(destination)] = {
+                'url': url,
+                'revision': revision,
+                'review_id': review_id,
+                'time': int(time.time())}
+
+            if exported:
+                self._entries[self._key(destination)]['export'] = True
+            if filtered:
+                self._entries[self._key(destination)]['filtered'] = True
+
+    def is_exported(self, destination):
+        entry = self._entries.get(self._key(destination))
+        return (entry is not None) and entry.get('export', False)
+
+    def is_filtered(self, destination):
+        entry = self._entries.get(self._key(destination))
+        return (entry is not None) and entry.get('filtered', False)
+
+    def invalidate(self, destination):
+        with self._lock:
+            entry = self._entries.get(self._key(destination))
+            if entry is not None:
+                entry['stale'] = True
+
+    def save(self):
+        with self._lock:
             try:
-                url = urllib.parse.urljoin(
-                    self._config.mainurl,
-                    '/'.join(['course', '{}?format=json'.format(course)]))
+                os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+                with open(self._filename + '.tmp', mode='w',
+                        encoding='utf8') as f:
+                    json.dump(self._entries, f,
+                        ensure_ascii=False, separators=(',', ':'))
+                os.replace(self._filename + '.tmp', self._filename)
+
+                for filename in self._merged:
+                    os.remove(filename)
+                self._merged = []
+            except OSError as e:
+                logging.error("Can't save manifest '%s'.\n%s",
+                    self._filename, e)
+
+
+class AnytaskCache:
+    def __init__(self, directory, ttl=0):
+        self._directory = directory
+        self._ttl = ttl
+
+    def _filename(self, url):
+        parts = urllib.parse.urlsplit(url)
+        name = '-'.join(filter(None, re.split(r'[^\w.]+',
+            '/'.join([parts.netloc, parts.path, parts.query]))))
+        return os.path.join(self._directory, name + '.json')
+
+    def get(self, url):
+        try:
+            with open(self._filename(url), encoding='utf8') as f:
+                entry = json.load(f)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logging.warning("Can't load cached '%s'.\n%s", url, e)
+            return None
+
+        return entry if entry.get('url') == url else None
 
-                with urllib.request.urlopen(url) as f:
-                    self._courses.append(
-                        (course, json.loads(f.read().decode('utf8'))))
-            except (ValueError,
-                urllib.error.HTTPError, urllib.error.URLError) as e:
-                logging.error("Can't load course #%s.\n%s", course, e)
+    def is_fresh(self, entry):
+        return time.time() - entry['time'] < self._ttl
 
     @staticmethod
-    def _normalize(task, tasks):
-        if task[0] is None:
-            return task[1].strip()
+    def validators(entry):
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+
+        return headers
+
+    def store(self, url, response, body):
+        self._save({
+            'url': url,
+            'etag': response.getheader('ETag'),
+            'last_modified': response.getheader('Last-Modified'),
+            'time': time.time(),
+            'body': body.decode('utf8')})
+
+    def touch(self, entry):
+        entry['time'] = time.time()
+        self._save(entry)
+
+    def _save(self, entry):
+        filename = self._filename(entry['url'])
 
-        return os.path.join(
-            Anytask._normalize(tasks[task[0]], tasks), task[1].strip())
+        try:
+            os.makedirs(self._directory, exist_ok=True)
+            with open(filename + '.tmp', mode='w', encoding='utf8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(filename + '.tmp', filename)
+        except OSError as e:
+            logging.warning("Can't cache '%s'.\n%s", entry['url'], e)
 
-    def _relocate(self, repo):
-        result = self._config.get_reloc(repo)
-        return (repo if result is None else result)
 
-    def _load_tasks(self):
-        info = {}
+class AnytaskJournal:
+    def __init__(self, directory, suffix=''):
+        self._directory = directory
+        self._filename = os.path.join(directory, STATE_DIR,
+            'journal' + suffix)
+        self._done = {}
+        self._unfinished = set()
+        self._file = None
+        self._lock = threading.Lock()
 
-        logging.info("Building tasks list")
-        for (course, item) in self._courses:
-            if 'tasks' not in item:
-                logging.error("Invalid course #%s information", course)
-                continue
+    def _key(self, destination):
+        return os.path.relpath(destination, self._directory).replace('\\', '/')
 
-            for task in item['tasks']:
-                try:
-                    info[task['task_id']] = (
-                        task['parent_task_id'], task['title'])
-                except KeyError as e:
-                    logging.error(
-                        "Invalid course #%s information.\n%s", course, e)
+    def load(self):
+        states = {}
 
-        self._task_names = {item[0]: Anytask._normalize(item[1], info)
-            for item in info.items()}
+        try:
+            with open(self._filename, encoding='utf8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        states[record['destination']] = record
+                    except (ValueError, KeyError):
+                        # The last line may be cut by an interruption
+                        continue
+        except FileNotFoundError:
+            logging.warning("No journal to resume from")
+        except OSError as e:
+            logging.error("Can't load journal '%s'.\n%s", self._filename, e)
 
-    def _parse(self):
-        self._load_tasks()
+        self._done = {key: record['revision']
+            for (key, record) in states.items() if record['state'] == 'done'}
+        self._unfinished = set(key
+            for (key, record) in states.items()
+                if record['state'] == 'started')
 
-        logging.info("Building solutions list")
-        self._tasks = {}
-        self._students = {}
-        self._solutions = []
+        logging.info("Journal: %s done, %s unfinished",
+            len(self._done), len(self._unfinished))
 
-        for (course, item) in self._courses:
-            logging.info("Processing course #%s", course)
+    def open(self, resume=False):
+        try:
+            os.makedirs(os.path.dirname(self._filename), exist_ok=True)
+            self._file = open(self._filename, mode='a' if resume else 'w',
+                encoding='utf8')
+        except OSError as e:
+            logging.error("Can't open journal '%s'.\n%s", self._filename, e)
 
-            if 'tasks' not in item:
-                logging.error("No tasks in course #%s", course)
-                continue
+    def is_done(self, destination, revision):
+        return self._done.get(self._key(destination)) == revision
 
-            for task in item['tasks']:
-                if 'task_id' not in task:
-                    logging.error("Invalid task in course #%s", course)
-                    continue
+    def is_unfinished(self, destination):
+        return self._key(destination) in self._unfinished
 
-                if 'title' not in task:
-                    logging.error("Task #%s has no title", task['task_id'])
-                    continue
+    def write(self, destination, state, revision):
+        if self._file is None:
+            return
+
+        with self._lock:
+            try:
+                self._file.write(json.dumps({
+                    'destination': self._key(destination),
+                    'state': state,
+                    'revision': revision,
+                    'time': int(time.time())}, ensure_ascii=False) + '\n')
+                self._file.flush()
+                os.fsync(self._file.fileno())
+            except OSError as e:
+                logging.error("Can't write journal.\n%s", e)
+
+    def close(self, completed=False):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        self._done = {}
+        self._unfinished = set()
+
+        if completed:
+            try:
+                os.remove(self._filename)
+            except OSError:
+                pass
+
+
+def remove_readonly(func, path, _=None):
+    # Windows refuses to remove read-only files, such as exported objects
+    # and svn pristine copies
+    os.chmod(path, stat.S_IWRITE)
+    func(path)
+
+
+class AnytaskObjectStore:
+    def __init__(self, directory):
+        self._directory = directory
+
+    def _add(self, path):
+        mode = os.stat(path).st_mode
+        digest = hashlib.sha1()
+
+        with open(path, mode='rb') as f:
+            for block in iter(lambda: f.read(1 << 16), b''):
+                digest.update(block)
+
+        # Objects are shared by hardlinks, so they are kept read-only
+        name = digest.hexdigest() + ('x' if mode & stat.S_IXUSR else '')
+        obj = os.path.join(self._directory, name[:2], name[2:])
 
-                task_name = self._task_names[task['task_id']]
-                task_title = task['title'].strip()
+        if not os.path.exists(obj):
+            os.makedirs(os.path.dirname(obj), exist_ok=True)
+            os.chmod(path, 0o555 if mode & stat.S_IXUSR else 0o444)
+            try:
+                os.replace(path, obj)
+            except OSError:
+                shutil.copy2(path, obj)
 
-                logging.info("Processing task '%s'", task_name)
+        return obj
 
-                if task_name not in self._tasks:
-                    self._tasks[(course, task_name)] = AnytaskTask(
-                        course, task_title, task_name)
+    @staticmethod
+    def _link(obj, target):
+        temp = target + '.anysync-tmp'
 
-                task_obj = self._tasks[(course, task_name)]
+        try:
+            os.link(obj, temp)
+        except OSError:
+            shutil.copy2(obj, temp)
 
-                if 'students' not in task:
-                    logging.error("No students in task #%s:'%s'",
-                        course, task_name)
+        try:
+            os.replace(temp, target)
+        except PermissionError:
+            os.chmod(target, stat.S_IWRITE)
+            os.replace(temp, target)
+
+    def install(self, source, destination):
+        keep = set()
+        linked = 0
+
+        # Kept paths are relative, so any spelling of destination works
+        for (dirpath, dirnames, filenames) in os.walk(source):
+            relative = os.path.normpath(os.path.relpath(dirpath, source))
+            target_dir = os.path.join(destination, relative)
+
+            if os.path.lexists(target_dir) and not os.path.isdir(target_dir):
+                os.remove(target_dir)
+            os.makedirs(target_dir, exist_ok=True)
+            keep.add(relative)
+
+            for name in filenames + [d for d in dirnames
+                    if os.path.islink(os.path.join(dirpath, d))]:
+                path = os.path.join(dirpath, name)
+                target = os.path.join(target_dir, name)
+                keep.add(os.path.normpath(os.path.join(relative, name)))
+
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target, onerror=remove_readonly)
+
+                if os.path.islink(path):
+                    os.replace(path, target)
                     continue
 
-                for student in task['students']:
-                    if 'user_name' not in student:
-                        logging.error("Invalid student in task #%s:'%s'",
-                            course, task_name)
-                        continue
+                obj = self._add(path)
+                if os.path.exists(target) and os.path.samefile(target, obj):
+                    continue
 
-                    full_name = student['user_name']
+                self._link(obj, target)
+                linked += 1
 
-                    if 'username' not in student:
-                        logging.error(
-                            "Invalid login of student '%s' in task #%s:'%s'",
-                            full_name, course, task_name)
-                        continue
+        for (dirpath, dirnames, filenames) in os.walk(destination):
+            for name in list(dirnames):
+                path = os.path.join(dirpath, name)
+                if os.path.relpath(path, destination) in keep:
+                    continue
+
+                if os.path.islink(path):
+                    os.remove(path)
+                else:
+                    shutil.rmtree(path, onerror=remove_readonly)
+                dirnames.remove(name)
+
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                if os.path.relpath(path, destination) not in keep:
+                    try:
+                        os.remove(path)
+                    except PermissionError:
+                        remove_readonly(os.remove, path)
+
+        logging.info("%s files of '%s' changed", linked, destination)
+
+    def collect(self):
+        removed = 0
+
+        # An object linked from nowhere else has only its own name left
+        for (dirpath, _, filenames) in os.walk(self._directory):
+            for name in filenames:
+                path = os.path.join(dirpath, name)
+                try:
+                    if os.lstat(path).st_nlink == 1:
+                        remove_readonly(os.remove, path)
+                        removed += 1
+                except OSError as e:
+                    logging.warning("Can't remove object '%s'.\n%s",
+                        path, e)
+
+        logging.info("%s unused objects removed", removed)
+
+
+class AnytaskMetrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self._phases = {}
+            self._counters = {}
+            # Retries and rechecks overwrite the sample of the same course
+            # or solution: Prometheus rejects duplicate series
+            self._courses = {}
+            self._solutions = {}
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases[name] = self._phases.get(name, 0) + (
+                    time.perf_counter() - start)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def course(self, course, seconds, size, status):
+        with self._lock:
+            self._courses[course] = {
+                'course': course,
+                'seconds': round(seconds, 6),
+                'bytes': size,
+                'status': status}
+
+    def solution(self, solution, seconds, code):
+        with self._lock:
+            key = (solution.task.course_id, solution.task.name,
+                solution.student.name)
+            self._solutions[key] = {
+                'course': solution.task.course_id,
+                'task': solution.task.name,
+                'student': solution.student.name,
+                'review_id': solution.svn.review_id,
+                'seconds': round(seconds, 6),
+                'code': code}
+
+    def _json(self):
+        return json.dumps({
+            'time': int(time.time()),
+            'phases': {name: round(seconds, 6)
+                for (name, seconds) in self._phases.items()},
+            'counters': self._counters,
+            'courses': list(self._courses.values()),
+            'solutions': list(self._solutions.values())},
+            ensure_ascii=False, indent=1)
+
+    @staticmethod
+    def _labels(**labels):
+        return '{' + ','.join('{}="{}"'.format(key, str(value).replace(
+            '\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+                for (key, value) in sorted(labels.items())) + '}'
+
+    def _prometheus(self):
+        lines = []
+
+        def metric(name, kind, text, samples):
+            lines.append('# HELP anysync_{} {}'.format(name, text))
+            lines.append('# TYPE anysync_{} {}'.format(name, kind))
+            for (labels, value) in samples:
+                lines.append('anysync_{}{} {}'.format(
+                    name, self._labels(**labels) if labels else '', value))
+
+        metric('last_run_timestamp_seconds', 'gauge',
+            'Time of the last run', [({}, int(time.time()))])
+        metric('phase_seconds', 'gauge', 'Wall time of each phase',
+            [({'phase': name}, round(seconds, 6))
+                for (name, seconds) in sorted(self._phases.items())])
+        metric('solutions', 'gauge', 'Solutions by result',
+            [({'result': name}, value)
+                for (name, value) in sorted(self._counters.items())])
+        metric('course_fetch_seconds', 'gauge', 'Course fetch latency',
+            [({'course': item['course'], 'status': item['status']},
+                item['seconds']) for item in self._courses.values()])
+        metric('course_fetch_bytes', 'gauge', 'Course fetch size',
+            [({'course': item['course'], 'status': item['status']},
+                item['bytes']) for item in self._courses.values()])
+        metric('checkout_seconds', 'gauge', 'Checkout duration',
+            [({key: item[key] for key in ['course', 'task', 'student']},
+                item['seconds']) for item in self._solutions.values()])
+        metric('checkout_exit_code', 'gauge', 'Checkout svn exit code',
+            [({key: item[key] for key in ['course', 'task', 'student']},
+                item['code']) for item in self._solutions.values()])
+
+        return '\n'.join(lines)
+
+    def save(self, filename):
+        with self._lock:
+            content = (self._prometheus() if filename.endswith('.prom') else
+                self._json())
 
-                    username = self._relocate(student['username'])
+        try:
+            with open(filename + '.tmp', mode='w', encoding='utf8') as f:
+                f.write(content + '\n')
+            os.replace(filename + '.tmp', filename)
+        except OSError as e:
+            logging.error("Can't save metrics '%s'.\n%s", filename, e)
 
-                    logging.info("Processing student '%s'", full_name)
 
-                    if username not in self._students:
-                        self._students[username] = AnytaskStudent(
-                            full_name, username)
+class AnytaskFileFilter:
+    def __init__(self, only=(), exclude=(), max_size=0):
+        self._only = sorted(only)
+        self._exclude = sorted(exclude)
+        self._max_size = max_size
 
-                    student_obj = self._students[username]
-                    solution_obj = AnytaskSolution(task_obj, student_obj)
+    @property
+    def active(self):
+        return bool(self._only or self._exclude or self._max_size)
 
-                    if ('svn' in student) and (student['svn'] is not None):
-                        if (('svn_path' not in student['svn']) or
-                            ('rb_review_id' not in student['svn']) or
-                            ('svn_rev' not in student['svn'])):
-                            logging.error("Invalid svn info of student '%s' in"
-                                " task #%s/'%s'", full_name, course, task_name)
-                        else:
-                            solution_obj.add_svn_info(
-                                AnytaskSVN(
-                                    student['svn']['svn_path'],
-                                    student['svn']['rb_review_id'],
-                                    student['svn']['svn_rev']))
+    @staticmethod
+    def _matches(name, path, patterns):
+        return any(fnmatch.fnmatch(name, pattern) or
+            fnmatch.fnmatch(path, pattern) for pattern in patterns)
 
-                    self._solutions.append(solution_obj)
+    def rejected(self, path, size):
+        # Returns the topmost path to leave out, or None if the file is wanted
+        parts = path.split('/')
 
-                logging.info("Processing task '%s' complete", task_name)
+        for index in range(len(parts)):
+            prefix = '/'.join(parts[:index + 1])
+            if self._matches(parts[index], prefix, self._exclude):
+                return prefix
 
-            logging.info("Processing course #%s complete", course)
+        if self._only and not self._matches(parts[-1], path, self._only):
+            return path
 
-    def __init__(self, configfile):
-        self._config = AnytaskConfig(configfile)
+        if self._max_size and (size > self._max_size):
+            return path
+
+        return None
 
-        self._setup_auth()
-        self._load_courses()
-        self._parse()
+
+class AnytaskJob:
+    def __init__(self, solution, svn_path, destination, forced=False):
+        self._solution = solution
+        self._svn_path = svn_path
+        self._destination = destination
+        self._forced = forced
 
     @property
-    def solutions(self):
-        return self._solutions
+    def solution(self):
+        return self._solution
 
     @property
-    def config(self):
-        return self._config
+    def svn_path(self):
+        return self._svn_path
 
-    def get_students(self):
-        return self._students.values()
+    @property
+    def destination(self):
+        return self._destination
 
-    def get_tasks(self):
-        cached = set()
-        result = []
+    @property
+    def forced(self):
+        return self._forced
+
+
+class AnytaskScheduler:
+    def __init__(self, jobs=1, rate=None, retries=0):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max(1, jobs))
+        self._limit = max(1, jobs)
+        self._retries = retries
+        self._interval = 1.0 / rate if rate else 0
+        self._next_start = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._ready = collections.deque()
+        self._delayed = []
+        self._sequence = 0
+        self._running = {}
+
+        # Additive increase, multiplicative decrease of parallel downloads
+        self._window = 1.0
+        self._threshold = float(self._limit)
+        self._latency = None
+
+    def submit(self, job, func, callback):
+        self._ready.append((job, func, callback, 0))
 
-        for task_id in sorted(self._task_names.keys()):
-            name = self._task_names[task_id]
-            if name not in cached:
-                cached.add(name)
-                result.append(name)
+    @staticmethod
+    def _timed(func, job):
+        start = time.perf_counter()
+        result = func(job)
+        return (result, time.perf_counter() - start)
 
-        return result
+    def _dispatch(self):
+        now = time.monotonic()
 
+        while self._delayed and self._delayed[0][0] <= now:
+            self._ready.append(heapq.heappop(self._delayed)[2])
 
-class AnytaskSynchronizer:
-    def _make_destination(self, solution, forced=False):
-        try:
-            path = os.path.join(self._anytask.config.course_name,
-                self._anytask.config.unsorted_name if forced else
-                    solution.task.name,
-                solution.student.name)
+        while self._ready and (len(self._running) < int(self._window)):
+            item = self._ready.popleft()
+            future = self._executor.submit(self._timed, item[1], item[0])
+            self._running[future] = item
 
-            if not os.path.isdir(path):
-                os.makedirs(path)
-        except OSError as e:
-            logging.error("Make directory error.\n%s", e)
+    def _timeout(self):
+        if not self._delayed:
             return None
 
-        return path
-
-    def _sync_solution(self, solution, args):
-        logging.info("Checking solution of #%s:'%s' by '%s'",
-            solution.task.course_id, solution.task.name, solution.student.name)
+        return max(0, self._delayed[0][0] - time.monotonic())
 
-        if solution.svn is None:
-            logging.info("SVN not found. Skip")
+    def throttle(self):
+        # Every svn process counts, including each one of a batch, group
+        # or filtered download
+        if not self._interval:
             return
 
-        svn_path = solution.svn.path
-        dest = None
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next_start)
+            self._next_start = start + self._interval
 
-        if svn_path in [None, '']:
-            svn_path = self._anytask.config.get_link(solution.svn.review_id)
+        self._stopped.wait(start - now)
 
-            if svn_path is None:
-                logging.warning("Solution have only review id #%s",
-                    solution.svn.review_id)
+    def _adjust(self, success, elapsed):
+        slow = success and (self._latency is not None) and (
+            elapsed > SVN_SLOW_FACTOR * self._latency)
 
-                if args.force:
-                    repo = solution.student.repo
+        if success:
+            self._latency = elapsed if self._latency is None else (
+                0.8 * self._latency + 0.2 * elapsed)
 
-                    if repo in self._forced:
-                        logging.info(
-                            "Repository '%s' already downloaded. Skip", repo)
-                        if args.ask_link:
-                            if self._ask_add_link(solution, args):
-                                logging.info("Rechecking needed")
-                                self._sync_solution(solution, args)
-                        return
+        if success and not slow:
+            self._window = min(self._limit, self._window + (
+                1 if self._window < self._threshold else 1 / self._window))
+        else:
+            self._threshold = max(1.0, self._window / 2)
+            self._window = self._threshold
 
-                    dest = self._make_destination(solution, True)
-                    if dest is None:
-                        return
+    def _retry(self, item):
+        (job, func, callback, attempt) = item
+        delay = min(RETRY_MAX_DELAY, RETRY_DELAY * 2 ** attempt) * (
+            random.uniform(0.5, 1.5))
 
-                    svn_path = ""
-                    self._forced.add(repo)
-                else:
-                    logging.warning("SVN path is not specified. Skip")
-                    return
-            else:
-                logging.info("Review id #%s will be used",
-                    solution.svn.review_id)
-        else:
-            rev_id = solution.svn.review_id
+        logging.warning("Download failed, retry %s of %s in %.1f s",
+            attempt + 1, self._retries, delay)
 
-            if self._anytask.config.get_link(rev_id) is not None:
-                logging.warning("ReviewBoard link to #%s is redundant", rev_id)
+        self._sequence += 1
+        heapq.heappush(self._delayed, (time.monotonic() + delay,
+            self._sequence, (job, func, callback, attempt + 1)))
 
-                if args.remove_links:
-                    self._anytask.config.remove_link(rev_id)
+    def run(self, feed=None):
+        while self._running or self._ready or self._delayed or feed:
+            # Jobs may keep arriving while the first ones are downloading
+            if (feed is not None) and not feed():
+                feed = None
 
-        if dest is None:
-            dest = self._make_destination(solution)
+            self._dispatch()
 
-        # Dirty fix for svn_path, coz it's calculated from different sources
-        if svn_path:
-            svn_path = svn_path.replace('\\', '/').replace(r'%5C', '/')
+            timeout = self._timeout()
+            if feed is not None:
+                timeout = PIPELINE_POLL if timeout is None else (
+                    min(timeout, PIPELINE_POLL))
 
-        if dest is not None:
-            if self._download(solution, svn_path, dest, args.svn_quiet):
-                if (svn_path == "") and args.ask_link:
-                    if self._ask_add_link(solution, args):
-                        logging.info("Rechecking needed")
-                        self._sync_solution(solution, args)
+            if not self._running:
+                time.sleep(timeout or 0)
+                continue
 
-    def _ask_add_link(self, solution, args):
-        def get_dirs(path, *exclude):
-            return filter(lambda d: (os.path.isdir(os.path.join(path, d)) and
-                (d not in exclude)), os.listdir(path))
+            done, _ = concurrent.futures.wait(
+                self._running, timeout=timeout,
+                return_when=concurrent.futures.FIRST_COMPLETED)
 
-        choices = []
-        try:
-            rootdir = os.path.join(
-                self._anytask.config.course_name,
-                self._anytask.config.unsorted_name,
-                solution.student.name)
+            for future in done:
+                item = self._running.pop(future)
+                (job, func, callback, attempt) = item
+                try:
+                    (result, elapsed) = future.result()
+                except Exception as e:
+                    logging.error("Download error.\n%s", e)
+                    (result, elapsed) = (False, None)
 
-            for _dir in get_dirs(rootdir, '.svn'):
-                if _dir not in ['branches', 'tags', 'trunk']:
-                    choices.append(_dir)
+                self._adjust(bool(result) and (not isinstance(result, dict)
+                    or all(result.values())), elapsed)
 
-                choices += map(
-                    lambda d: os.path.join(_dir, d),
-                    get_dirs(os.path.join(rootdir, _dir), '.svn'))
-        except OSError:
-            return False
+                # Grouped jobs report partial results and are not retried
+                if (result is False) and (attempt < self._retries):
+                    self._retry(item)
+                    continue
 
-        print("Select path to task '{}' or enter path "
-            "manually (empty to skip):".format(solution.task.name))
+                callback(job, result)
 
-        for item in enumerate(choices):
-            print("{:2d} {}".format(item[0] + 1, item[1]))
+    def shutdown(self):
+        # After an interrupt only the downloads already running are awaited
+        self._stopped.set()
+        self._executor.shutdown(cancel_futures=True)
 
-        answer = input()
-        if answer == '':
-            logging.info("Selection canceled")
-            if (args.ignore is not None) and (None in args.ignore):
-                rid = solution.svn.review_id
 
-                if self._anytask.config.add_ignore(rid):
-                    logging.info("Review '%s' will be ignored", rid)
-            return False
+class AnytaskStage:
+    _END = object()
+
+    def __init__(self, items, size=PIPELINE_QUEUE):
+        self._queue = queue.Queue(size)
+        self._error = None
+        self._done = False
+
+        thread = threading.Thread(target=self._produce, args=(items,),
+            daemon=True)
+        thread.start()
 
+    def _produce(self, items):
         try:
-            answer = int(answer)
-            if not (0 < answer <= len(choices)):
-                return None
-            answer = choices[answer - 1]
+            for item in items:
+                self._queue.put(item)
+        except Exception as e:
+            self._error = e
+        finally:
+            self._queue.put(AnytaskStage._END)
+
+    def _finished(self):
+        self._done = True
+        if self._error is not None:
+            raise self._error
+
+    @property
+    def done(self):
+        return self._done
+
+    def __iter__(self):
+        while not self._done:
+            item = self._queue.get()
+            if item is AnytaskStage._END:
+                self._finished()
+                break
+
+            yield item
+
+    def poll(self):
+        items = []
+
+        while not self._done:
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+
+            if item is AnytaskStage._END:
+                self._finished()
+                break
+
+            items.append(item)
+
+        return items
+
+
+class AnytaskCircuitBreaker:
+    def __init__(self, threshold=0):
+        self._threshold = threshold
+        self._failures = {}
+        self._open = set()
+        self._lock = threading.Lock()
+
+    def allow(self, host):
+        with self._lock:
+            return host not in self._open
+
+    def record(self, host, success):
+        with self._lock:
+            if success:
+                self._failures[host] = 0
+                return
+
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if self._threshold and (host not in self._open) and (
+                    self._failures[host] >= self._threshold):
+                logging.error("%s downloads from '%s' failed in a row, "
+                    "skipping the rest", self._failures[host], host)
+                self._open.add(host)
+
+
+class AnytaskSession:
+    def __init__(self, mainurl, username, password, connect_timeout=None,
+            read_timeout=None):
+        self._mainurl = mainurl
+        self._connect_timeout = connect_timeout or None
+        self._read_timeout = read_timeout or None
+        self._authorization = 'Basic ' + base64.b64encode(
+            ':'.join([username, password]).encode('utf8')).decode('ascii')
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _proxy(scheme, netloc):
+        # Proxies are taken from the environment, as urllib does
+        proxy = urllib.request.getproxies().get(scheme)
+        if (not proxy) or urllib.request.proxy_bypass(netloc):
+            return (None, {})
+
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        parts = urllib.parse.urlsplit(proxy)
+
+        headers = {}
+        if parts.username is not None:
+            headers['Proxy-Authorization'] = 'Basic ' + base64.b64encode(
+                ':'.join([urllib.parse.unquote(parts.username),
+                    urllib.parse.unquote(parts.password or '')]).encode(
+                        'utf8')).decode('ascii')
+
+        return (parts.netloc.rpartition('@')[2], headers)
+
+    def _connect(self, scheme, netloc):
+        cache = getattr(self._local, 'connections', None)
+        if cache is None:
+            cache = self._local.connections = {}
+
+        if (scheme, netloc) not in cache:
+            (proxy, proxy_headers) = self._proxy(scheme, netloc)
+            connection_class = (http.client.HTTPSConnection
+                if scheme == 'https' else http.client.HTTPConnection)
+            connection = connection_class(proxy or netloc,
+                timeout=self._connect_timeout)
+
+            # HTTPS goes through a tunnel, plain HTTP asks the proxy for
+            # absolute URLs
+            if proxy and (scheme == 'https'):
+                connection.set_tunnel(netloc, headers=proxy_headers)
+                proxy_headers = None
+            elif not proxy:
+                proxy_headers = None
+            cache[(scheme, netloc)] = (connection, proxy_headers)
+
+            with self._lock:
+                self._connections.append(connection)
+
+        return cache[(scheme, netloc)]
+
+    def _request(self, url, headers):
+        parts = urllib.parse.urlsplit(url)
+        (connection, proxy_headers) = self._connect(parts.scheme,
+            parts.netloc)
+
+        if proxy_headers is None:
+            path = urllib.parse.urlunsplit(('', '', parts.path or '/',
+                parts.query, ''))
+        else:
+            path = urllib.parse.urlunsplit(parts[:4] + ('',))
+            headers = dict(headers, **proxy_headers)
+
+        for attempt in range(2):
+            try:
+                if connection.sock is None:
+                    connection.connect()
+                    connection.sock.settimeout(self._read_timeout)
+
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                return (response, response.read())
+            except (http.client.RemoteDisconnected,
+                    ConnectionResetError, BrokenPipeError):
+                # Server has closed the idle keep-alive connection
+                connection.close()
+                if attempt:
+                    raise
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                raise
+
+    def _headers(self, url, headers):
+        request_headers = {'Accept-Encoding': 'gzip'}
+
+        # Credentials never leave the configured server
+        (scheme, netloc) = urllib.parse.urlsplit(url)[:2]
+        (main_scheme, main_netloc) = urllib.parse.urlsplit(self._mainurl)[:2]
+        if (scheme, netloc.lower()) == (main_scheme, main_netloc.lower()):
+            request_headers['Authorization'] = self._authorization
+
+        request_headers.update(headers or {})
+        return request_headers
+
+    def get(self, url, headers=None):
+        for _ in range(HTTP_MAX_REDIRECTS):
+            try:
+                (response, body) = self._request(url,
+                    self._headers(url, headers))
+            except (OSError, http.client.HTTPException) as e:
+                raise urllib.error.URLError(e)
+
+            if response.status in (301, 302, 303, 307, 308):
+                url = urllib.parse.urljoin(url, response.getheader('Location'))
+                continue
+
+            if response.status >= 400:
+                raise urllib.error.HTTPError(url, response.status,
+                    response.reason, response.headers, None)
+
+            if response.getheader('Content-Encoding') == 'gzip':
+                try:
+                    body = gzip.decompress(body)
+                except (OSError, EOFError) as e:
+                    raise urllib.error.URLError(
+                        "Broken gzip body: {}".format(e))
+
+            return (response, body)
+
+        raise urllib.error.URLError("Too many redirects")
+
+    def close(self):
+        with self._lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+
+
+class ConfigParseError(Exception):
+    pass
+
+
+class AnytaskParseError(Exception):
+    pass
+
+
+class AnytaskLoader:
+    def __init__(self, offline=False, metrics=None):
+        self._metrics = AnytaskMetrics() if metrics is None else metrics
+        self._offline = offline
+        self._sessions = {}
+        self._caches = {}
+        self._server_errors = 0
+        self._lock = threading.Lock()
+
+    @property
+    def server_errors(self):
+        return self._server_errors
+
+    def _session(self, config):
+        key = (config.mainurl, config.username, config.password)
+
+        if key not in self._sessions:
+            with self._metrics.phase('auth'):
+                logging.info("Prepare BasicHTTP authorization")
+
+                self._sessions[key] = AnytaskSession(config.mainurl,
+                    config.username, config.password,
+                    config.connect_timeout, config.read_timeout)
+
+                logging.info("BasicHTTP authorization ready")
+
+        return self._sessions[key]
+
+    def _cache(self, config):
+        key = (config.cache_dir, config.cache_ttl)
+
+        if key not in self._caches:
+            self._caches[key] = AnytaskCache(*key)
+
+        return self._caches[key]
+
+    def _load_course(self, config, course):
+        logging.info("Loading course #%s", course)
+        start = time.perf_counter()
+        (size, status) = (0, 'error')
+        cache = self._cache(config)
+        try:
+            url = urllib.parse.urljoin(
+                config.mainurl,
+                '/'.join(['course', '{}?format=json'.format(course)]))
+
+            entry = cache.get(url)
+
+            if (entry is not None) and (
+                    self._offline or cache.is_fresh(entry)):
+                logging.info("Using cached course #%s", course)
+                body = entry['body']
+                status = 'cached'
+            elif self._offline:
+                logging.error("Course #%s is not cached", course)
+                return None
+            else:
+                (response, body) = self._session(config).get(url,
+                    AnytaskCache.validators(entry or {}))
+                size = int(response.getheader('Content-Length') or len(body))
+
+                if response.status == 304:
+                    logging.info("Course #%s not modified", course)
+                    cache.touch(entry)
+                    body = entry['body']
+                    status = 'not_modified'
+                else:
+                    cache.store(url, response, body)
+                    body = body.decode('utf8')
+                    status = 'ok'
+
+            return (config.mainurl, course, json.loads(body))
+        except (ValueError, EOFError, OSError) as e:
+            logging.error("Can't load course #%s.\n%s", course, e)
+            status = 'error'
+
+            if isinstance(e, urllib.error.URLError) and not (
+                    isinstance(e, urllib.error.HTTPError) and e.code < 500):
+                with self._lock:
+                    self._server_errors += 1
+        finally:
+            self._metrics.course(course,
+                time.perf_counter() - start, size, status)
+
+        return None
+
+    def load_courses(self, configs):
+        # A course shared by several configs is fetched only once
+        courses = {}
+        for config in configs:
+            for course in config.courses_id:
+                courses.setdefault((config.mainurl, course), config)
+
+        self._server_errors = 0
+        if not courses:
+            return
+
+        for config in configs:
+            self._session(config)
+
+        # Only a few fetches run ahead of parsing, so at most that many
+        # course documents are held in memory
+        keys = iter(courses)
+        pending = collections.deque()
+        workers = max(1, min(len(courses), HTTP_CONNECTIONS))
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=workers) as executor:
+            while True:
+                for key in itertools.islice(keys, workers - len(pending)):
+                    pending.append(executor.submit(
+                        self._load_course, courses[key], key[1]))
+
+                if not pending:
+                    break
+
+                item = pending.popleft().result()
+                if item is not None:
+                    yield item
+
+        for session in self._sessions.values():
+            session.close()
+
+
+class Anytask:
+    def _normalize(self, task_id):
+        chain = []
+        current = task_id
+
+        while (current is not None) and (current not in self._task_names):
+            if current in chain:
+                logging.error("Task #%s has cyclic parents", task_id)
+                current = None
+                break
+
+            if current not in self._task_info:
+                logging.error("Task #%s has unknown parent #%s",
+                    task_id, current)
+                current = None
+                break
+
+            chain.append(current)
+            current = self._task_info[current][0]
+
+        name = None if current is None else self._task_names[current]
+        for item in reversed(chain):
+            title = self._task_info[item][1].strip()
+            name = title if name is None else os.path.join(name, title)
+            self._task_names[item] = name
+
+        return self._task_names[task_id]
+
+    def _relocate(self, repo):
+        result = self._config.get_reloc(repo)
+        return (repo if result is None else result)
+
+    def _parse_course(self, course, item):
+        logging.info("Processing course #%s", course)
+
+        if 'tasks' not in item:
+            logging.error("No tasks in course #%s", course)
+            return
+
+        tasks = []
+        for task in item['tasks']:
+            if 'task_id' not in task:
+                logging.error("Invalid task in course #%s", course)
+                continue
+
+            if 'title' not in task:
+                logging.error("Task #%s has no title", task['task_id'])
+                continue
+
+            if 'parent_task_id' not in task:
+                logging.error("Task #%s has no parent", task['task_id'])
+                continue
+
+            self._task_info[task['task_id']] = (
+                task['parent_task_id'], task['title'])
+            tasks.append(task)
+
+        for task in tasks:
+            task_name = self._normalize(task['task_id'])
+            task_title = task['title'].strip()
+
+            logging.info("Processing task '%s'", task_name)
+
+            if (course, task_name) not in self._tasks:
+                self._tasks[(course, task_name)] = AnytaskTask(
+                    course, task_title, task_name)
+
+            task_obj = self._tasks[(course, task_name)]
+
+            if 'students' not in task:
+                logging.error("No students in task #%s:'%s'",
+                    course, task_name)
+                continue
+
+            if self._stage < STAGE_STUDENTS:
+                continue
+
+            for student in task['students']:
+                self._parse_student(course, task_obj, student)
+
+            logging.info("Processing task '%s' complete", task_name)
+
+        logging.info("Processing course #%s complete", course)
+
+    def _parse_student(self, course, task_obj, student):
+        task_name = task_obj.name
+
+        if 'user_name' not in student:
+            logging.error("Invalid student in task #%s:'%s'",
+                course, task_name)
+            return
+
+        full_name = student['user_name']
+
+        if 'username' not in student:
+            logging.error(
+                "Invalid login of student '%s' in task #%s:'%s'",
+                full_name, course, task_name)
+            return
+
+        username = self._relocate(student['username'])
+
+        logging.info("Processing student '%s'", full_name)
+
+        if username not in self._students:
+            self._students[username] = AnytaskStudent(
+                full_name, username)
+
+        if self._stage < STAGE_SOLUTIONS:
+            return
+
+        student_obj = self._students[username]
+        solution_obj = AnytaskSolution(task_obj, student_obj)
+
+        if ('svn' in student) and (student['svn'] is not None):
+            if (('svn_path' not in student['svn']) or
+                ('rb_review_id' not in student['svn']) or
+                ('svn_rev' not in student['svn'])):
+                logging.error("Invalid svn info of student '%s' in"
+                    " task #%s/'%s'", full_name, course, task_name)
+            else:
+                solution_obj.add_svn_info(
+                    AnytaskSVN(
+                        student['svn']['svn_path'],
+                        student['svn']['rb_review_id'],
+                        student['svn']['svn_rev']))
+
+        self._index.add(len(self._solutions), solution_obj)
+        self._solutions.append(solution_obj)
+
+    def _reset(self):
+        self._task_info = {}
+        self._task_names = {}
+        self._tasks = {}
+        self._students = {}
+        self._solutions = []
+        self._index = AnytaskIndex()
+
+    @staticmethod
+    def _parse(views, stage=STAGE_SOLUTIONS):
+        for _ in Anytask._parse_courses(views, stage):
+            pass
+
+    @staticmethod
+    def _parse_courses(views, stage=STAGE_SOLUTIONS):
+        logging.info("Building solutions list")
+        for view in views:
+            view._reset()
+            view._stage = stage
+
+        metrics = views[0]._metrics
+        courses = views[0]._loader.load_courses(
+            [view.config for view in views])
+
+        # Every course document is released as soon as it is processed
+        while True:
+            with metrics.phase('courses'):
+                loaded = next(courses, None)
+
+            if loaded is None:
+                break
+
+            (mainurl, course, item) = loaded
+            parsed = []
+            with metrics.phase('parse'):
+                for view in views:
+                    if (view.config.mainurl == mainurl) and (
+                            course in view.config.courses_id):
+                        first = len(view._solutions)
+                        view._parse_course(course, item)
+                        parsed.append(
+                            (view, range(first, len(view._solutions))))
+
+            yield from parsed
+
+    def __init__(self, configfile, offline=False, metrics=None, loader=None):
+        self._metrics = AnytaskMetrics() if metrics is None else metrics
+        self._config = AnytaskConfig(configfile)
+        self._loader = (AnytaskLoader(offline, self._metrics)
+            if loader is None else loader)
+        self._stage = 0
+        self._reset()
+
+    def _build(self, stage):
+        # Courses are loaded only when a command needs more than the config
+        if self._stage < stage:
+            Anytask._parse([self], stage)
+
+    @staticmethod
+    def load(configfiles, offline=False, metrics=None):
+        metrics = AnytaskMetrics() if metrics is None else metrics
+        loader = AnytaskLoader(offline, metrics)
+        views = [Anytask(configfile, offline, metrics, loader)
+            for configfile in configfiles]
+
+        Anytask._parse(views)
+        return views
+
+    def refresh(self):
+        Anytask._parse([self])
+        return self._loader.server_errors == 0
+
+    @property
+    def solutions(self):
+        self._build(STAGE_SOLUTIONS)
+        return self._solutions
+
+    @property
+    def config(self):
+        return self._config
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    def get_students(self):
+        self._build(STAGE_STUDENTS)
+        return self._students.values()
+
+    def select(self, courses=None, tasks=None, students=None, ignore=()):
+        self._build(STAGE_SOLUTIONS)
+        return self._select(range(len(self._solutions)),
+            courses, tasks, students, ignore)
+
+    def stream(self, courses=None, tasks=None, students=None, ignore=()):
+        if self._stage >= STAGE_SOLUTIONS:
+            yield self.select(courses, tasks, students, ignore)
+            return
+
+        # Solutions of each course are selected as soon as it is parsed
+        for (_, positions) in Anytask._parse_courses([self]):
+            yield self._select(positions, courses, tasks, students, ignore)
+
+    def _select(self, candidates, courses, tasks, students, ignore):
+        positions = None
+
+        for (dimension, keys) in [
+                ('course', courses), ('task', tasks), ('student', students)]:
+            if keys is None:
+                continue
+
+            found = self._index.lookup(dimension, keys)
+            positions = found if positions is None else positions & found
+
+        if positions is None:
+            positions = candidates
+        else:
+            positions = positions & set(candidates)
+
+        ignored = self._index.lookup('review', ignore)
+        self._metrics.count('ignored',
+            len([position for position in ignored if position in positions]))
+
+        return [self._solutions[position] for position in sorted(positions)
+            if position not in ignored]
+
+    def get_tasks(self):
+        self._build(STAGE_TASKS)
+        cached = set()
+        result = []
+
+        for task_id in sorted(self._task_names.keys()):
+            name = self._task_names[task_id]
+            if name not in cached:
+                cached.add(name)
+                result.append(name)
+
+        return result
+
+
+class AnytaskPlan:
+    def __init__(self, config, metrics=None):
+        self._config = config
+        self._metrics = AnytaskMetrics() if metrics is None else metrics
+
+    @property
+    def config(self):
+        return self._config
+
+    @property
+    def metrics(self):
+        return self._metrics
+
+    @staticmethod
+    def shard_of(repo, count):
+        digest = hashlib.sha1(repo.encode('utf8')).hexdigest()
+        return int(digest, 16) % count + 1
+
+    def save(self, filename, jobs):
+        items = [{
+            'course_id': job.solution.task.course_id,
+            'task_title': job.solution.task.title,
+            'task': job.solution.task.name,
+            'student': job.solution.student.name,
+            'repo': job.solution.student.repo,
+            'path': job.svn_path,
+            'review_id': job.solution.svn.review_id,
+            'revision': job.solution.svn.revision,
+            'url': urllib.parse.urljoin(self._config.svn_link,
+                '/'.join([job.solution.student.repo, job.svn_path])),
+            'destination': os.path.relpath(job.destination,
+                self._config.course_name).replace('\\', '/'),
+            'forced': job.forced} for job in jobs]
+
+        try:
+            with open(filename + '.tmp', mode='w', encoding='utf8') as f:
+                json.dump({
+                    'course': self._config.course_name,
+                    'svn': self._config.svn_link,
+                    'time': int(time.time()),
+                    'solutions': items}, f, ensure_ascii=False, indent=1)
+            os.replace(filename + '.tmp', filename)
+        except OSError as e:
+            logging.error("Can't save plan '%s'.\n%s", filename, e)
+            return False
+
+        logging.info("Plan of %s solutions saved to '%s'",
+            len(items), filename)
+        return True
+
+    def load(self, filename, shard=None):
+        logging.info("Loading plan from '%s'", filename)
+
+        try:
+            with open(filename, encoding='utf8') as f:
+                plan = json.load(f)
+
+            if plan['svn'] != self._config.svn_link:
+                logging.warning("Plan was made for svn '%s'", plan['svn'])
+
+            jobs = []
+            for item in plan['solutions']:
+                if (shard is not None) and (
+                        self.shard_of(item['repo'], shard[1]) != shard[0]):
+                    continue
+
+                solution = AnytaskSolution(
+                    AnytaskTask(item['course_id'], item['task_title'],
+                        item['task']),
+                    AnytaskStudent(item['student'], item['repo']))
+                solution.add_svn_info(AnytaskSVN(item['path'],
+                    item['review_id'], item['revision']))
+
+                jobs.append(AnytaskJob(solution, item['path'],
+                    os.path.join(self._config.course_name,
+                        *item['destination'].split('/')),
+                    item['forced']))
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logging.critical("Can't load plan '%s'.\n%s", filename, e)
+            raise AnytaskParseError()
+
+        logging.info("Plan: %s solutions to download", len(jobs))
+        return jobs
+
+
+class AnytaskSynchronizer:
+    # svn runs in its own session and misses the terminal's Ctrl-C, so
+    # running processes are tracked to be killed on interrupt
+    _processes = set()
+    _processes_lock = threading.Lock()
+    _stopping = False
+
+    def _make_destination(self, solution, forced=False):
+        try:
+            path = os.path.join(self._anytask.config.course_name,
+                self._anytask.config.unsorted_name if forced else
+                    solution.task.name,
+                solution.student.name)
+
+            if (self._plan is None) and not os.path.isdir(path):
+                os.makedirs(path)
+        except OSError as e:
+            logging.error("Make directory error.\n%s", e)
+            return None
+
+        return path
+
+    def _sync_solution(self, solution, args):
+        logging.info("Checking solution of #%s:'%s' by '%s'",
+            solution.task.course_id, solution.task.name, solution.student.name)
+
+        if solution.svn is None:
+            logging.info("SVN not found. Skip")
+            self._report(solution, 'skipped')
+            return
+
+        svn_path = solution.svn.path
+        dest = None
+        forced = False
+
+        if svn_path in [None, '']:
+            svn_path = self._anytask.config.get_link(solution.svn.review_id)
+
+            if svn_path is None:
+                logging.warning("Solution have only review id #%s",
+                    solution.svn.review_id)
+
+                if args.force:
+                    repo = solution.student.repo
+
+                    if repo in self._forced:
+                        logging.info(
+                            "Repository '%s' already downloaded. Skip", repo)
+                        if args.ask_link:
+                            if repo in self._pending:
+                                self._pending[repo].append(solution)
+                            else:
+                                self._recheck(solution, args)
+                        else:
+                            self._report(solution, 'skipped')
+                        return
+
+                    dest = self._make_destination(solution, True)
+                    if dest is None:
+                        self._report(solution, 'failed')
+                        return
+
+                    svn_path = ""
+                    forced = True
+                    self._forced.add(repo)
+                    self._pending[repo] = []
+                else:
+                    logging.warning("SVN path is not specified. Skip")
+                    self._report(solution, 'skipped')
+                    return
+            else:
+                logging.info("Review id #%s will be used",
+                    solution.svn.review_id)
+        else:
+            rev_id = solution.svn.review_id
+
+            if self._anytask.config.get_link(rev_id) is not None:
+                logging.warning("ReviewBoard link to #%s is redundant", rev_id)
+
+                if args.remove_links:
+                    self._anytask.config.remove_link(rev_id)
+
+        if dest is None:
+            dest = self._make_destination(solution)
+
+        # Dirty fix for svn_path, coz it's calculated from different sources
+        if svn_path:
+            svn_path = svn_path.replace('\\', '/').replace(r'%5C', '/')
+
+        if dest is None:
+            self._report(solution, 'failed')
+            return
+
+        self._submit(AnytaskJob(solution, svn_path, dest, forced), args)
+
+    def _submit(self, job, args):
+        solution = job.solution
+        dest = job.destination
+        forced = job.forced
+
+        if self._plan is not None:
+            self._plan.append(job)
+            self._report(solution, 'planned')
+            return
+
+        if (not forced) and self._journal.is_done(
+                dest, solution.svn.revision):
+            logging.info("Already downloaded to '%s'. Skip", dest)
+            self._report(solution, 'resumed')
+            return
+
+        self._journal.write(dest, 'planned', solution.svn.revision)
+
+        if (self._groups is not None) and not forced:
+            self._groups.setdefault(solution.student.repo, []).append(job)
+            return
+
+        if (self._batches is not None) and not forced:
+            self._batches.setdefault(solution.student.repo, []).append(job)
+            return
+
+        self._scheduler.submit(job,
+            lambda job: self._run_job(job, args),
+            lambda job, result: self._downloaded(job, result, args))
+
+    def _submit_groups(self, args):
+        groups = self._groups
+        self._groups = None
+
+        for (repo, jobs) in groups.items():
+            self._scheduler.submit(jobs,
+                lambda jobs: self._run_group(jobs, args),
+                lambda jobs, results: [
+                    self._downloaded(job, results.get(job, False), args)
+                        for job in jobs])
+
+    def _submit_batches(self, args):
+        batches = self._batches
+        self._batches = None
+
+        for (repo, jobs) in batches.items():
+            self._scheduler.submit(jobs,
+                lambda jobs: self._run_batch(jobs, args),
+                lambda jobs, results: [
+                    self._downloaded(job, results.get(job, False), args)
+                        for job in jobs])
+
+    def _start(self, job):
+        if self._journal.is_unfinished(job.destination) and (
+                self._working_copy(job.destination)):
+            logging.info("Cleaning up '%s'", job.destination)
+            self._call(["svn", "cleanup", job.destination])
+
+        self._journal.write(job.destination, 'started',
+            job.solution.svn.revision)
+
+    def _host(self, job):
+        parts = urllib.parse.urlsplit(self._url(job.solution, job.svn_path))
+        return parts.netloc or parts.scheme
+
+    def _run_job(self, job, args):
+        host = self._host(job)
+        if not self._breaker.allow(host):
+            return None
+
+        with self._exclusive([job]):
+            self._start(job)
+            self._local.host_failed = False
+
+            if (self._store is not None) and not job.forced:
+                result = self._download_export(job, args.svn_quiet)
+            else:
+                result = self._download(
+                    job.solution, job.svn_path, job.destination,
+                    args.svn_quiet, job.forced and args.ask_link, job.forced)
+
+        self._host_failure(job, result)
+        return result
+
+    def _run_group(self, jobs, args):
+        return self._run_jobs(jobs, self._download_group, args)
+
+    def _run_batch(self, jobs, args):
+        return self._run_jobs(jobs, self._download_batch, args)
+
+    def _run_jobs(self, jobs, download, args):
+        host = self._host(jobs[0])
+        if not self._breaker.allow(host):
+            return {job: None for job in jobs}
+
+        with self._exclusive(jobs):
+            for job in jobs:
+                self._start(job)
+            self._local.host_failed = False
+
+            results = download(jobs, args.svn_quiet)
+
+        for job in jobs:
+            self._host_failure(job, results.get(job, False))
+        return results
+
+    @contextlib.contextmanager
+    def _exclusive(self, jobs):
+        # The same task of a student in several courses shares a directory
+        paths = sorted(set(os.path.abspath(job.destination) for job in jobs))
+        with self._lock:
+            locks = [self._destinations.setdefault(path, threading.Lock())
+                for path in paths]
+
+        with contextlib.ExitStack() as stack:
+            for lock in locks:
+                stack.enter_context(lock)
+            yield
+
+    def _host_failure(self, job, result):
+        # Only the last attempt of a job counts, see _downloaded
+        with self._lock:
+            if (result is False) and self._local.host_failed:
+                self._host_failed.add(job)
+            else:
+                self._host_failed.discard(job)
+
+    def _downloaded(self, job, result, args):
+        solution = job.solution
+        self._journal.write(job.destination,
+            'done' if result else 'failed', solution.svn.revision)
+
+        # A solution failed on its own, e.g. with a wrong path, still shows
+        # that the server works
+        if result is not None:
+            with self._lock:
+                host_failed = job in self._host_failed
+                self._host_failed.discard(job)
+            self._breaker.record(self._host(job), result or not host_failed)
+
+        if result is None:
+            status = 'unavailable'
+        elif job.forced:
+            status = 'forced' if result else 'failed'
+        else:
+            status = 'downloaded' if result else 'failed'
+
+        self._report(solution, status)
+        if not job.forced:
+            return
+
+        waiting = self._pending.pop(solution.student.repo, [])
+        if args.ask_link:
+            if result:
+                self._recheck(solution, args)
+
+            for other in waiting:
+                self._recheck(other, args)
+
+    def _recheck(self, solution, args):
+        if self._ask_add_link(solution, args):
+            logging.info("Rechecking needed")
+            self._sync_solution(solution, args)
+        else:
+            self._report(solution, 'skipped')
+
+    def _report(self, solution, status):
+        self._results[solution] = status
+
+    def _print_summary(self):
+        counts = {}
+
+        for (solution, status) in self._results.items():
+            counts[status] = counts.get(status, 0) + 1
+            self._anytask.metrics.count(status)
+            (logging.error if status in ('failed', 'unavailable') else
+                logging.info)(
+                "%s:'%s' (%s): %s", solution.task.course_id,
+                solution.task.name, solution.student.name, status)
+
+        logging.info("Summary: %s", ', '.join(
+            '{} {}'.format(count, status)
+            for (status, count) in sorted(counts.items())) or 'nothing to do')
+
+    def _ask_add_link(self, solution, args):
+        def get_dirs(path, *exclude):
+            return filter(lambda d: (os.path.isdir(os.path.join(path, d)) and
+                (d not in exclude)), os.listdir(path))
+
+        choices = []
+        try:
+            rootdir = os.path.join(
+                self._anytask.config.course_name,
+                self._anytask.config.unsorted_name,
+                solution.student.name)
+
+            for _dir in get_dirs(rootdir, '.svn'):
+                if _dir not in ['branches', 'tags', 'trunk']:
+                    choices.append(_dir)
+
+                choices += map(
+                    lambda d: os.path.join(_dir, d),
+                    get_dirs(os.path.join(rootdir, _dir), '.svn'))
+        except OSError:
+            return False
+
+        print("Select path to task '{}' or enter path "
+            "manually (empty to skip):".format(solution.task.name))
+
+        for item in enumerate(choices):
+            print("{:2d} {}".format(item[0] + 1, item[1]))
+
+        answer = input()
+        if answer == '':
+            logging.info("Selection canceled")
+            if (args.ignore is not None) and (None in args.ignore):
+                rid = solution.svn.review_id
+
+                if self._anytask.config.add_ignore(rid):
+                    logging.info("Review '%s' will be ignored", rid)
+            return False
+
+        try:
+            answer = int(answer)
+            if not (0 < answer <= len(choices)):
+                return None
+            answer = choices[answer - 1]
         except ValueError:
-            if not os.path.isdir(os.path.join(rootdir, answer)):
+            answer = answer.strip().replace('\\', '/').strip('/')
+            if not (os.path.isdir(os.path.join(rootdir, answer)) or
+                    self._remote_exists(solution, answer)):
                 logging.error("Path '%s' is incorrect", answer)
                 sys.stderr.write("Incorrect path\n")
                 return False
 
         return self._anytask.config.add_link([solution.svn.review_id, answer])
 
-    def _download(self, solution, svnpath, destination, quiet=False):
+    def _svn_command(self, command):
+        return [
+            "svn", command,
+            "--no-auth-cache",
+            "--username", self._anytask.config.username,
+            "--password", self._anytask.config.password]
+
+    def _call(self, callargs, quiet=False, stderr=None, output=None):
+        config = self._anytask.config
+        start = time.monotonic()
+        progress = [start]
+        host_error = [False]
+
+        # svn runs in its own process group so a hung one can be killed
+        # with all of its children; its output is the progress signal
+        def relay(stream):
+            for line in iter(stream.readline, b''):
+                progress[0] = time.monotonic()
+                if output is not None:
+                    output.append(line)
+                elif not quiet:
+                    sys.stdout.buffer.write(line)
+                    sys.stdout.buffer.flush()
+
+        def scan(stream):
+            for line in iter(stream.readline, b''):
+                if SVN_HOST_ERRORS.search(line):
+                    host_error[0] = True
+                sys.stderr.buffer.write(line)
+                sys.stderr.buffer.flush()
+
+        if self._scheduler is not None:
+            self._scheduler.throttle()
+
+        try:
+            proc = self._spawn(callargs,
+                subprocess.PIPE if stderr is None else stderr)
+        except OSError as e:
+            logging.error("Can't run svn.\n%s", e)
+            return -1
+
+        readers = [threading.Thread(target=relay, args=(proc.stdout,),
+            daemon=True)]
+        if proc.stderr is not None:
+            readers.append(threading.Thread(target=scan,
+                args=(proc.stderr,), daemon=True))
+        for reader in readers:
+            reader.start()
+
+        try:
+            while True:
+                try:
+                    code = proc.wait(timeout=1)
+                    break
+                except subprocess.TimeoutExpired:
+                    now = time.monotonic()
+
+                if config.svn_timeout and (
+                        now - start > config.svn_timeout):
+                    logging.error("svn runs longer than %s s, killing",
+                        config.svn_timeout)
+                elif config.svn_stall_timeout and (
+                        now - progress[0] > config.svn_stall_timeout):
+                    logging.error("svn made no progress for %s s, killing",
+                        config.svn_stall_timeout)
+                else:
+                    continue
+
+                self._kill(proc)
+                proc.wait()
+                self._local.host_failed = True
+                return -1
+        finally:
+            for reader in readers:
+                reader.join()
+            proc.stdout.close()
+            if proc.stderr is not None:
+                proc.stderr.close()
+            with self._processes_lock:
+                self._processes.discard(proc)
+
+        if host_error[0]:
+            self._local.host_failed = True
+        return code
+
+    @classmethod
+    def _spawn(cls, callargs, stderr):
+        with cls._processes_lock:
+            if cls._stopping:
+                raise OSError("synchronization is interrupted")
+
+            proc = subprocess.Popen(callargs,
+                stdout=subprocess.PIPE, stderr=stderr,
+                **({'start_new_session': True} if os.name == 'posix' else
+                    {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}))
+            cls._processes.add(proc)
+
+        return proc
+
+    @classmethod
+    def _shutdown(cls, scheduler, completed):
+        if not completed:
+            with cls._processes_lock:
+                cls._stopping = True
+                for proc in cls._processes:
+                    if proc.poll() is None:
+                        cls._kill(proc)
+
+        try:
+            scheduler.shutdown()
+        finally:
+            cls._stopping = False
+
+    @staticmethod
+    def _kill(proc):
+        try:
+            if os.name == 'posix':
+                os.killpg(proc.pid, signal.SIGKILL)
+            else:
+                subprocess.call(
+                    ["taskkill", "/F", "/T", "/PID", str(proc.pid)],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError as e:
+            logging.warning("Can't kill svn.\n%s", e)
+            proc.kill()
+
+    @staticmethod
+    def _same_url(first, second):
+        return (urllib.parse.unquote(first).rstrip('/') ==
+            urllib.parse.unquote(second).rstrip('/'))
+
+    @staticmethod
+    def _is_under(url, root):
+        return (AnytaskSynchronizer._same_url(url, root) or
+            urllib.parse.unquote(url).startswith(
+                urllib.parse.unquote(root).rstrip('/') + '/'))
+
+    def _relocate(self, solution, url, wc_root, destination, quiet=False):
+        lines = []
+        code = self._call(self._svn_command("info") + [
+            "--xml", '@'.join([url, solution.svn.revision])],
+            stderr=subprocess.DEVNULL, output=lines)
+        if code != 0:
+            return None
+
+        try:
+            root = xml.etree.ElementTree.fromstring(b''.join(lines)).find(
+                'entry/repository/root').text.strip()
+        except (xml.etree.ElementTree.ParseError, AttributeError):
+            return None
+
+        logging.info("Relocating '%s' from '%s' to '%s'",
+            destination, wc_root, root)
+
+        # svn refuses to relocate to a repository with another UUID
+        code = self._call(self._svn_command("relocate") + [
+            wc_root, root, destination], quiet)
+        return root if code == 0 else None
+
+    @staticmethod
+    def _working_copy(destination):
+        if not os.path.isdir(os.path.join(destination, '.svn')):
+            return None
+
+        try:
+            result = xml.etree.ElementTree.fromstring(
+                subprocess.check_output(
+                    ["svn", "info", "--xml", destination],
+                    stderr=subprocess.DEVNULL, timeout=SVN_INFO_TIMEOUT))
+
+            return (result.find('entry/url').text.strip(),
+                result.find('entry/repository/root').text.strip())
+        except subprocess.TimeoutExpired:
+            raise
+        except Exception as e:
+            logging.warning("Working copy '%s' is corrupted.\n%s",
+                destination, e)
+            return False
+
+    def _url(self, solution, svnpath):
+        return urllib.parse.urljoin(
+            self._anytask.config.svn_link,
+            '/'.join([solution.student.repo, svnpath]))
+
+    def _download(self, solution, svnpath, destination, quiet=False,
+            sparse=False, forced=False):
         logging.info("SVN '%s' found, revision %s",
             svnpath, solution.svn.revision)
 
+        start = time.perf_counter()
+
+        # Sparse download fetches only two levels of directories; a full
+        # forced download deepens a copy left sparse by an earlier run
+        depth = (["--set-depth", "immediates"] if sparse else
+            ["--set-depth", "infinity"] if forced else [])
+        checkout_depth = ["--depth", "immediates"] if sparse else []
+
         try:
-            url = urllib.parse.urljoin(
-                self._anytask.config.svn_link,
-                '/'.join([solution.student.repo, svnpath]))
+            url = self._url(solution, svnpath)
+
+            exported = self._manifest.is_exported(destination)
+            was_filtered = self._manifest.is_filtered(destination)
+            # Whole repositories of forced downloads are not filtered
+            filtered = self._filter.active and not forced
+            self._manifest.invalidate(destination)
+            working_copy = self._working_copy(destination)
+
+            if (working_copy is None) and exported:
+                # Exported files may be hardlinks into the object store
+                logging.info("Replacing export '%s'", destination)
+                shutil.rmtree(destination, onerror=remove_readonly)
+                os.makedirs(destination)
+            elif (working_copy is False) or (
+                    working_copy and (filtered != was_filtered)):
+                logging.info("Removing '%s'", destination)
+                shutil.rmtree(destination, onerror=remove_readonly)
+                os.makedirs(destination)
+                working_copy = None
+            elif working_copy is not None:
+                (wc_url, wc_root) = working_copy
+
+                # A repository moved to another address is relocated
+                # instead of being downloaded again
+                if not self._is_under(url, wc_root):
+                    root = self._relocate(solution, url, wc_root,
+                        destination, quiet)
+
+                    if root is None:
+                        logging.error("Repository of '%s' changed, remove "
+                            "it to download again", destination)
+                        self._anytask.metrics.solution(solution,
+                            time.perf_counter() - start, -1)
+                        return False
+
+                    wc_url = root.rstrip('/') + wc_url[len(
+                        wc_root.rstrip('/')):]
+
+                if self._same_url(wc_url, url):
+                    logging.info("Updating '%s'", destination)
+                    callargs = self._svn_command("update") + depth + [
+                        "--force", "-r", solution.svn.revision, destination]
+                elif not filtered:
+                    logging.info("Switching '%s' from '%s'",
+                        destination, wc_url)
+                    callargs = self._svn_command("switch") + depth + [
+                        "--force",
+                        '@'.join([url, solution.svn.revision]), destination]
+                else:
+                    logging.info("Path of '%s' changed, removing",
+                        destination)
+                    shutil.rmtree(destination, onerror=remove_readonly)
+                    os.makedirs(destination)
+                    working_copy = None
+
+            if not working_copy:
+                callargs = self._svn_command("checkout") + (
+                    checkout_depth) + [
+                    "--force",
+                    '@'.join([url, solution.svn.revision]), destination]
+
+            if filtered:
+                code = self._download_filtered(solution, url, destination,
+                    bool(working_copy), quiet)
+            else:
+                code = self._call(callargs, quiet)
 
-            callargs = [
-                "svn", "checkout",
-                "--force",
-                "--no-auth-cache",
-                "--username", self._anytask.config.username,
-                "--password", self._anytask.config.password]
-            if quiet:
-                callargs.append("--quiet")
-            callargs += ['@'.join([url, solution.svn.revision]), destination]
+            if (code == 0) and sparse:
+                code = self._deepen(solution, destination, quiet)
 
-            code = subprocess.call(callargs)
+            self._anytask.metrics.solution(solution,
+                time.perf_counter() - start, code)
 
             if code != 0:
                 logging.error("Download error: svn returns %s", code)
                 return False
         except Exception as e:
             logging.error("Download error.\n%s", e)
+            self._anytask.metrics.solution(solution,
+                time.perf_counter() - start, -1)
             return False
 
+        self._manifest.record(destination,
+            url, solution.svn.revision, solution.svn.review_id,
+            filtered=filtered)
+
         logging.info("Downloaded to '%s'", destination)
         return True
 
-    def _is_updated(self, solution):
-        logging.info("Checking update %s:'%s' by '%s'",
-            solution.task.course_id, solution.task.name, solution.student.name)
+    def _download_filtered(self, solution, url, destination, update,
+            quiet=False):
+        revision = solution.svn.revision
+        listing = []
+
+        code = self._call(self._svn_command("list") + [
+            "-R", "--xml", '@'.join([url, revision])], output=listing)
+        if code != 0:
+            return code
+
+        wanted = []
+        skipped = []
+        excluded = set()
+        for entry in xml.etree.ElementTree.fromstring(
+                b''.join(listing)).iter('entry'):
+            if entry.get('kind') != 'file':
+                continue
+
+            path = entry.findtext('name')
+            size = int(entry.findtext('size') or 0)
+            rejected = self._filter.rejected(path, size)
+
+            if rejected is None:
+                wanted.append(os.path.join(destination, *path.split('/')))
+                continue
 
-        path = os.path.join(self._anytask.config.course_name,
+            skipped.append((path, size))
+            local = os.path.join(destination, *rejected.split('/'))
+            if update and os.path.lexists(local):
+                excluded.add(local)
+
+        # Files are added one by one to a working copy of empty directories
+        for chunk in self._chunks(sorted(excluded)):
+            if self._call(self._svn_command("update") + [
+                    "--set-depth", "exclude"] + chunk, quiet) != 0:
+                logging.warning("Can't leave out filtered files of '%s'",
+                    destination)
+
+        if update:
+            code = self._call(self._svn_command("update") + [
+                "--force", "-r", revision, destination], quiet)
+        else:
+            code = self._call(self._svn_command("checkout") + [
+                "--depth", "empty", "--force",
+                '@'.join([url, revision]), destination], quiet)
+
+        for chunk in self._chunks(wanted):
+            if code != 0:
+                break
+
+            code = self._call(self._svn_command("update") + [
+                "--parents", "--force", "-r", revision] + chunk, quiet)
+
+        if skipped:
+            size = sum(size for (_, size) in skipped)
+            logging.warning("Skipped %s files (%s bytes) of '%s'",
+                len(skipped), size, destination)
+            for (path, size) in skipped:
+                logging.info("Skipped '%s'", path)
+
+            self._anytask.metrics.count('filtered_files', len(skipped))
+            self._anytask.metrics.count('filtered_bytes', size)
+
+        return code
+
+    def _deepen(self, solution, destination, quiet=False):
+        subdirs = [os.path.join(destination, d)
+            for d in sorted(os.listdir(destination))
+                if (d != '.svn') and
+                    os.path.isdir(os.path.join(destination, d))]
+
+        for chunk in self._chunks(subdirs):
+            code = self._call(
+                self._svn_command("update") + [
+                    "--set-depth", "immediates",
+                    "-r", solution.svn.revision] + chunk, quiet)
+
+            if code != 0:
+                return code
+
+        return 0
+
+    def _remote_exists(self, solution, svnpath):
+        code = self._call(
+            self._svn_command("info") + [
+                '@'.join([self._url(solution, svnpath),
+                    solution.svn.revision])],
+            quiet=True, stderr=subprocess.DEVNULL)
+
+        return code == 0
+
+    @staticmethod
+    def _chunks(paths, limit=SVN_ARGV_LIMIT):
+        chunk = []
+        size = 0
+
+        for path in paths:
+            if chunk and size + len(path) + 1 > limit:
+                yield chunk
+                chunk = []
+                size = 0
+
+            chunk.append(path)
+            size += len(path) + 1
+
+        if chunk:
+            yield chunk
+
+    @staticmethod
+    def _svn_revisions(paths):
+        return {path: revision for (path, (revision, _))
+            in AnytaskSynchronizer._svn_info(paths).items()}
+
+    @staticmethod
+    def _svn_info(paths):
+        entries = {}
+
+        for chunk in AnytaskSynchronizer._chunks(paths):
+            logging.info("Checking %s working copies", len(chunk))
+
+            try:
+                with subprocess.Popen(["svn", "info", "--xml"] + chunk,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.DEVNULL) as proc:
+                    timer = threading.Timer(SVN_INFO_TIMEOUT,
+                        AnytaskSynchronizer._expire, (proc,))
+                    timer.start()
+                    try:
+                        AnytaskSynchronizer._parse_info(proc.stdout, entries)
+                    finally:
+                        timer.cancel()
+            except (OSError, xml.etree.ElementTree.ParseError) as e:
+                logging.error("Checking error.\n%s", e)
+
+        return entries
+
+    @staticmethod
+    def _parse_info(stream, entries):
+        for (_, entry) in xml.etree.ElementTree.iterparse(stream):
+            if entry.tag != 'entry':
+                continue
+
+            if ('path' in entry.attrib) and ('revision' in entry.attrib):
+                url = entry.findtext('url')
+                entries[os.path.normpath(entry.get('path'))] = (
+                    entry.get('revision'), url.strip() if url else None)
+
+            entry.clear()
+
+    @staticmethod
+    def _expire(proc):
+        logging.error("svn info runs longer than %s s, killing",
+            SVN_INFO_TIMEOUT)
+        proc.kill()
+
+    def _solution_path(self, solution):
+        return os.path.join(self._anytask.config.course_name,
             solution.task.name, solution.student.name)
 
-        if not os.path.isdir(path):
-            return solution.svn is None
+    def _download_group(self, jobs, quiet=False):
+        repo = jobs[0].solution.student.repo
+        mirror = os.path.join(self._anytask.config.course_name,
+            STATE_DIR, 'mirror', repo)
+        repo_url = urllib.parse.urljoin(self._anytask.config.svn_link,
+            repo + '/')
+        results = {}
 
-        try:
-            result = subprocess.check_output(["svn", "info", "--xml", path])
-        except subprocess.CalledProcessError as e:
-            logging.error("Checking error: svn returns %s", e.returncode)
-            return False
+        logging.info("Fetching %s solutions from repository '%s'",
+            len(jobs), repo)
 
         try:
-            xml_result = xml.dom.minidom.parseString(result)
+            if self._working_copy(mirror) is None:
+                os.makedirs(mirror, exist_ok=True)
+                code = self._call(
+                    self._svn_command("checkout") + [
+                        "--depth", "empty", repo_url, mirror], quiet)
+
+                if code != 0:
+                    logging.error("Download error: svn returns %s", code)
+                    return results
+
+            revisions = {}
+            for job in jobs:
+                revisions.setdefault(job.solution.svn.revision, []).append(job)
+
+            for (revision, rev_jobs) in sorted(revisions.items()):
+                targets = sorted(set(
+                    os.path.join(mirror, job.svn_path.strip('/'))
+                        for job in rev_jobs))
+
+                failed = set()
+                for chunk in self._chunks(targets):
+                    code = self._call(
+                        self._svn_command("update") + [
+                            "--parents", "--set-depth", "infinity",
+                            "-r", revision] + chunk, quiet)
+
+                    if code != 0:
+                        logging.error("Fetch of '%s' revision %s failed: "
+                            "svn returns %s", repo, revision, code)
+                        failed.update(chunk)
+
+                for job in rev_jobs:
+                    source = os.path.join(mirror, job.svn_path.strip('/'))
+
+                    # The mirror may still hold an older revision there
+                    if source in failed:
+                        results[job] = False
+                    else:
+                        results[job] = self._materialize(job, source, quiet)
         except Exception as e:
-            logging.error("Invalid output\n%s", e)
+            logging.error("Download error.\n%s", e)
+
+        return results
+
+    def _download_batch(self, jobs, quiet=False):
+        repo = jobs[0].solution.student.repo
+        results = {}
+
+        # Only plain updates of existing working copies share a process
+        urls = {}
+        unknown = []
+        for job in jobs:
+            if not os.path.isdir(os.path.join(job.destination, '.svn')):
+                continue
+
+            entry = self._manifest.get(job.destination)
+            if entry is not None:
+                urls[job] = entry['url']
+            else:
+                unknown.append(job)
+
+        if unknown:
+            info = self._svn_info([job.destination for job in unknown])
+            for job in unknown:
+                (_, url) = info.get(
+                    os.path.normpath(job.destination), (None, None))
+                if url is not None:
+                    urls[job] = url
+
+        revisions = {}
+        for job in jobs:
+            url = self._url(job.solution, job.svn_path)
+
+            if (job in urls) and self._same_url(urls[job], url):
+                revisions.setdefault(
+                    job.solution.svn.revision, []).append(job)
+            else:
+                results[job] = self._download(job.solution, job.svn_path,
+                    job.destination, quiet)
+
+        for (revision, rev_jobs) in sorted(revisions.items()):
+            logging.info("Updating %s solutions from repository '%s'",
+                len(rev_jobs), repo)
+
+            for job in rev_jobs:
+                self._manifest.invalidate(job.destination)
+
+            start = time.perf_counter()
+            code = 0
+            try:
+                for chunk in self._chunks(
+                        [job.destination for job in rev_jobs]):
+                    code = self._call(
+                        self._svn_command("update") + [
+                            "--force", "-r", revision] + chunk,
+                        quiet) or code
+            except OSError as e:
+                logging.error("Download error.\n%s", e)
+                code = -1
+
+            elapsed = (time.perf_counter() - start) / len(rev_jobs)
+
+            # One process serves many targets, so each is verified apart
+            updated = self._svn_revisions(
+                [job.destination for job in rev_jobs])
+            for job in rev_jobs:
+                result = updated.get(
+                    os.path.normpath(job.destination)) == revision
+                self._anytask.metrics.solution(job.solution, elapsed,
+                    0 if result else (code or -1))
+
+                if result:
+                    self._manifest.record(job.destination,
+                        self._url(job.solution, job.svn_path),
+                        revision, job.solution.svn.review_id)
+                    logging.info("Downloaded to '%s'", job.destination)
+                else:
+                    logging.warning("'%s' is not updated to revision %s, "
+                        "retrying alone", job.destination, revision)
+                    result = self._download(job.solution, job.svn_path,
+                        job.destination, quiet)
+
+                results[job] = result
+
+        return results
+
+    def _materialize(self, job, source, quiet=False):
+        if not os.path.isdir(source):
+            logging.error("Download error: '%s' not found in repository "
+                "'%s'", job.svn_path, job.solution.student.repo)
             return False
 
-        entries = xml_result.getElementsByTagName('entry')
-        if len(entries) == 0:
-            logging.error("No 'entry' item in result")
+        return self._export(job, source, quiet)
+
+    def _download_export(self, job, quiet=False):
+        solution = job.solution
+
+        logging.info("SVN '%s' found, revision %s",
+            job.svn_path, solution.svn.revision)
+
+        return self._export(job,
+            '@'.join([self._url(solution, job.svn_path),
+                solution.svn.revision]),
+            quiet, remote=True)
+
+    def _export(self, job, source, quiet=False, remote=False):
+        destination = job.destination
+        solution = job.solution
+
+        self._manifest.invalidate(destination)
+        start = time.perf_counter()
+        code = -1
+
+        # Staging stays inside the course for os.replace to work
+        staging = tempfile.mkdtemp(dir=self._staging)
+        exported = os.path.join(staging, 'export')
+        try:
+            callargs = (self._svn_command("export") if remote else
+                ["svn", "export"])
+            code = self._call(callargs + ["--force", source, exported], quiet)
+
+            if code != 0:
+                logging.error("Export error: svn returns %s", code)
+                return False
+
+            if self._store is None:
+                if os.path.lexists(destination):
+                    shutil.rmtree(destination, onerror=remove_readonly)
+                os.replace(exported, destination)
+            else:
+                self._store.install(exported, destination)
+        except OSError as e:
+            logging.error("Export error.\n%s", e)
+            code = -1
             return False
+        finally:
+            try:
+                shutil.rmtree(staging, onerror=remove_readonly)
+            except OSError as e:
+                logging.warning("Can't remove '%s'.\n%s", staging, e)
+            self._anytask.metrics.solution(solution,
+                time.perf_counter() - start, code)
+
+        self._manifest.record(destination,
+            self._url(solution, job.svn_path),
+            solution.svn.revision, solution.svn.review_id, exported=True)
+
+        logging.info("Exported to '%s'", destination)
+        return True
+
+    def _is_updated(self, solution, revisions):
+        logging.info("Checking update %s:'%s' by '%s'",
+            solution.task.course_id, solution.task.name, solution.student.name)
+
+        path = self._solution_path(solution)
+
+        if not os.path.isdir(path):
+            return solution.svn is None
+
+        entry = self._manifest.get(path)
+        if entry is not None:
+            return entry['revision'] == solution.svn.revision
 
-        if 'revision' not in entries[0].attributes:
-            logging.error("No 'revision' attribute in result")
+        revision = revisions.get(os.path.normpath(path))
+        if revision is None:
+            logging.error("Checking error: no revision of '%s'", path)
             return False
 
-        return entries[0].attributes['revision'].value == solution.svn.revision
+        return revision == solution.svn.revision
 
     def _filter_solutions(self, args):
-        def selected(selector, *values):
-            return ((selector is None) or
-                (len(set(values) & set(selector)) != 0))
-
-        return filter(
-            lambda solution:
-                selected(args.course,
-                    solution.task.course_id) and
-                selected(args.task,
-                    solution.task.name, solution.task.title) and
-                selected(args.student,
-                    solution.student.name, solution.student.repo) and
-                (solution.svn is not None and
-                    solution.svn.review_id not in self._anytask.config.ignore),
-            self._anytask.solutions)
-
-    def __init__(self, anytask):
+        return [solution for batch in self._filtered(args)
+            for solution in batch]
+
+    def _filtered(self, args):
+        batches = self._anytask.stream(args.course, args.task, args.student,
+            self._anytask.config.ignore)
+
+        for batch in batches:
+            with self._anytask.metrics.phase('filter'):
+                batch = [solution for solution in batch
+                    if solution.svn is not None]
+
+            yield batch
+
+    def _updated(self, batches):
+        for batch in batches:
+            with self._anytask.metrics.phase('update_check'):
+                revisions = self._svn_revisions(
+                    path for path in map(self._solution_path, batch)
+                        if os.path.isdir(path) and
+                            self._manifest.get(path) is None)
+
+                batch = [solution for solution in batch
+                    if not self._is_updated(solution, revisions)]
+
+            yield batch
+
+    def __init__(self, anytask, shard=None):
         self._anytask = anytask
+        self._plan = None
         self._forced = set()
+        self._pending = {}
+        self._results = {}
+        self._scheduler = None
+        self._groups = None
+        self._batches = None
+        self._store = None
+        self._staging = os.path.join(anytask.config.course_name, STATE_DIR,
+            'staging')
+        self._breaker = AnytaskCircuitBreaker()
+        self._host_failed = set()
+        self._destinations = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._filter = AnytaskFileFilter()
+        suffix = '' if shard is None else '.shard-{}-of-{}'.format(*shard)
+        self._manifest = AnytaskManifest(anytask.config.course_name, suffix)
+        self._journal = AnytaskJournal(anytask.config.course_name, suffix)
+
+    def _selected(self, args):
+        # Courses are loaded, filtered and checked while the solutions
+        # of earlier courses are already downloading
+        stage = AnytaskStage(self._filtered(args))
+        if args.update:
+            stage = AnytaskStage(self._updated(stage))
+
+        return stage
 
     def synchronize(self, args):
         logging.info("Start synchronization")
 
-        solutions = (self.get_updated(args) if args.update else
-            self._filter_solutions(args))
+        self._synchronize(self._selected(args), args)
+        logging.info("Synchronization completed")
+
+    @staticmethod
+    def synchronize_all(syncs, args):
+        logging.info("Start synchronization of %s courses", len(syncs))
+
+        # Downloads of all courses share one scheduler; each config keeps
+        # its own circuit breaker limit
+        scheduler = AnytaskScheduler(args.jobs, args.svn_rate, args.retries)
 
-        for solution in solutions:
-            self._sync_solution(solution, args)
+        with contextlib.ExitStack() as stack:
+            for sync in syncs:
+                sync._forced = set()
+                sync._results = {}
+                stack.enter_context(sync._anytask.config.transaction())
+
+            completed = False
+            try:
+                with syncs[0]._anytask.metrics.phase('sync'):
+                    stages = []
+                    for sync in syncs:
+                        sync._prepare(args, scheduler, AnytaskCircuitBreaker(
+                            sync._anytask.config.svn_max_failures))
+                        stages.append((sync, sync._selected(args)))
+
+                    scheduler.run(lambda: any([sync._poll(stage, args)
+                        for (sync, stage) in stages]))
+                    completed = True
+            finally:
+                AnytaskSynchronizer._shutdown(scheduler, completed)
+                for sync in syncs:
+                    sync._finish(completed)
+
+        for sync in syncs:
+            logging.info("Course '%s':", sync._anytask.config.course_name)
+            sync._print_summary()
 
         logging.info("Synchronization completed")
 
+    def _synchronize(self, stage, args, jobs=()):
+        self._forced = set()
+        self._results = {}
+
+        with self._anytask.metrics.phase('sync'), \
+                self._anytask.config.transaction():
+            self._run(stage, args, jobs)
+
+        self._print_summary()
+
+    def plan(self, args):
+        logging.info("Start planning")
+
+        self._forced = set()
+        self._results = {}
+        self._plan = []
+
+        with self._anytask.config.transaction():
+            for solution in self._filter_solutions(args):
+                self._sync_solution(solution, args)
+
+        jobs = self._plan
+        self._plan = None
+
+        self._print_summary()
+        return AnytaskPlan(self._anytask.config).save(args.plan, jobs)
+
+    def execute(self, args):
+        logging.info("Start execution of plan '%s'", args.execute)
+
+        jobs = []
+        for job in AnytaskPlan(self._anytask.config).load(
+                args.execute, args.shard):
+            try:
+                os.makedirs(job.destination, exist_ok=True)
+                jobs.append(job)
+            except OSError as e:
+                logging.error("Make directory error.\n%s", e)
+
+        self._synchronize(AnytaskStage([]), args, jobs)
+        logging.info("Execution completed")
+
+    @staticmethod
+    def _key(solution):
+        return (solution.task.course_id, solution.task.name,
+            solution.student.repo)
+
+    @staticmethod
+    def _state(solution):
+        return (solution.svn.path, solution.svn.revision,
+            solution.svn.review_id)
+
+    def watch(self, args):
+        logging.info("Start watching every %s seconds", args.watch)
+
+        states = None
+        delay = args.watch
+
+        try:
+            while True:
+                if states is None:
+                    states = {self._key(solution): self._state(solution)
+                        for solution in self._filter_solutions(args)}
+                    solutions = (self.get_updated(args) if args.update else
+                        self._filter_solutions(args))
+                else:
+                    # Saved metrics describe the last cycle only
+                    self._anytask.metrics.reset()
+
+                    try:
+                        refreshed = self._anytask.refresh()
+                    except Exception as e:
+                        logging.error("Refresh error.\n%s", e)
+                        refreshed = False
+
+                    if refreshed:
+                        delay = args.watch
+                    else:
+                        delay = min(delay * 2,
+                            max(args.watch, WATCH_MAX_BACKOFF))
+                        logging.warning(
+                            "Server error, next check in %s seconds", delay)
+
+                    solutions = [solution
+                        for solution in self._filter_solutions(args)
+                            if states.get(self._key(solution)) !=
+                                self._state(solution)]
+
+                if solutions:
+                    logging.info("%s solutions changed", len(solutions))
+                    self._synchronize(AnytaskStage([solutions]), args)
+
+                    for solution in solutions:
+                        states[self._key(solution)] = self._state(solution)
+
+                    # Failed solutions are retried in the next cycle
+                    for (solution, status) in self._results.items():
+                        if status == 'failed':
+                            states.pop(self._key(solution), None)
+
+                if args.metrics:
+                    self._anytask.metrics.save(args.metrics)
+
+                time.sleep(delay)
+        except KeyboardInterrupt:
+            logging.info("Watching stopped")
+
+    def _prepare(self, args, scheduler, breaker):
+        config = self._anytask.config
+
+        self._scheduler = scheduler
+        self._breaker = breaker
+        self._filter = AnytaskFileFilter(
+            config.only | set(args.only or ()),
+            config.exclude | set(args.exclude or ()),
+            config.max_file_size if args.max_file_size is None else
+                args.max_file_size)
+
+        if self._filter.active and (args.group_repos or args.export):
+            logging.warning("File filters apply only to working copies")
+        elif self._filter.active and args.batch:
+            logging.warning("File filters turn off batched updates")
+        self._groups = {} if args.group_repos else None
+        self._batches = ({} if args.batch and not (
+            args.group_repos or args.export or self._filter.active) else None)
+        if args.export:
+            self._store = AnytaskObjectStore(os.path.join(
+                self._anytask.config.course_name, STATE_DIR, 'objects'))
+        if args.export or args.group_repos:
+            self._clear_staging()
+
+        if args.resume:
+            self._journal.load()
+        self._journal.open(args.resume)
+
+    def _clear_staging(self):
+        # Exports interrupted in an earlier run leave their staging behind
+        try:
+            if os.path.isdir(self._staging):
+                shutil.rmtree(self._staging, onerror=remove_readonly)
+            os.makedirs(self._staging, exist_ok=True)
+        except OSError as e:
+            logging.warning("Can't clear '%s'.\n%s", self._staging, e)
+
+    def _poll(self, stage, args):
+        if stage.done:
+            return False
+
+        for batch in stage.poll():
+            for solution in batch:
+                self._sync_solution(solution, args)
+
+        if not stage.done:
+            return True
+
+        # Grouped downloads need every solution of a repository
+        if self._groups is not None:
+            self._submit_groups(args)
+        if self._batches is not None:
+            self._submit_batches(args)
+
+        return False
+
+    def _finish(self, completed):
+        self._manifest.save()
+        self._journal.close(completed)
+
+        if self._store is not None:
+            self._store.collect()
+
+    def _run(self, stage, args, jobs=()):
+        self._prepare(args,
+            AnytaskScheduler(args.jobs, args.svn_rate, args.retries),
+            AnytaskCircuitBreaker(self._anytask.config.svn_max_failures))
+
+        completed = False
+        try:
+            for job in jobs:
+                self._submit(job, args)
+
+            self._scheduler.run(lambda: self._poll(stage, args))
+            completed = True
+        finally:
+            self._shutdown(self._scheduler, completed)
+            self._finish(completed)
+
     def get_updated(self, args):
-        return filter(
-            lambda solution: not self._is_updated(solution),
-            self._filter_solutions(args))
+        return [solution for batch in self._updated(self._filtered(args))
+            for solution in batch]
+
+
+def parse_shard(value):
+    try:
+        (index, count) = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError(
+            "invalid shard '{}', expected I/N".format(value))
+
+    if not (0 < index <= count):
+        raise argparse.ArgumentTypeError(
+            "invalid shard '{}', expected 1 <= I <= N".format(value))
+
+    return (index, count)
 
 
 def main():
@@ -671,7 +3169,9 @@ def main():
     parser.add_argument(
         '-C', '--config',
         metavar='FILENAME',
-        default='anysync.conf', help='configuration file')
+        action='append',
+        help='configuration file or directory of *.conf files'
+            ' (default: anysync.conf)')
     parser.add_argument(
         '-c', '--course',
         metavar='ID',
@@ -720,12 +3220,77 @@ def main():
         '-a', '--ask-link',
         action='store_true',
         help='ask link to add for force when `svn_path` is empty')
+    parser.add_argument(
+        '-j', '--jobs',
+        metavar='N', type=int,
+        default=1, help='number of parallel downloads')
+    parser.add_argument(
+        '--svn-rate',
+        metavar='RPS', type=float,
+        help='run at most RPS svn commands per second')
+    parser.add_argument(
+        '--retries',
+        metavar='N', type=int,
+        default=2, help='retry failed downloads N times')
+    parser.add_argument(
+        '--group-repos',
+        action='store_true',
+        help='fetch each student repository once and export tasks locally')
+    parser.add_argument(
+        '--batch',
+        action='store_true',
+        help='update working copies of a repository with one svn process')
+    parser.add_argument(
+        '--export',
+        action='store_true',
+        help='export solutions without svn metadata, sharing equal files')
+    parser.add_argument(
+        '--only',
+        metavar='PATTERN',
+        action='append',
+        help='download only files matching the pattern (e.g. *.py)')
+    parser.add_argument(
+        '--exclude',
+        metavar='PATTERN',
+        action='append',
+        help='do not download files or directories matching the pattern')
+    parser.add_argument(
+        '--max-file-size',
+        metavar='BYTES', type=int,
+        help='do not download files larger than BYTES')
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='continue an interrupted synchronization')
+    parser.add_argument(
+        '--plan',
+        metavar='FILENAME',
+        help='write the download plan to a file and exit')
+    parser.add_argument(
+        '--execute',
+        metavar='FILENAME',
+        help='download solutions from a plan file without AnyTask')
+    parser.add_argument(
+        '--shard',
+        metavar='I/N', type=parse_shard,
+        help='execute only the I-th of N parts of the plan')
     parser.add_argument(
         '-u', '--update',
         action='store_true', help='download only new or modified repos')
+    parser.add_argument(
+        '--watch',
+        metavar='SECONDS', type=int,
+        help='keep running and synchronize changes every SECONDS')
     parser.add_argument(
         '-U', '--update-info',
         action='store_true', help='show new or modified repos')
+    parser.add_argument(
+        '--offline',
+        action='store_true', help='use cached courses only')
+    parser.add_argument(
+        '--metrics',
+        metavar='FILENAME',
+        help='write run metrics as JSON or Prometheus textfile (*.prom)')
     parser.add_argument(
         '-Q', '--svn-quiet',
         action='store_true', help='svn quiet mode')
@@ -747,6 +3312,30 @@ def main():
     if args.ask_link and not args.force:
         parser.error("--ask-link requires --force")
 
+    if args.jobs < 1:
+        parser.error("--jobs must be positive")
+
+    if (args.svn_rate is not None) and (args.svn_rate <= 0):
+        parser.error("--svn-rate must be positive")
+
+    if args.retries < 0:
+        parser.error("--retries must not be negative")
+
+    if (args.max_file_size is not None) and (args.max_file_size < 0):
+        parser.error("--max-file-size must not be negative")
+
+    if (args.watch is not None) and (args.watch < 1):
+        parser.error("--watch must be positive")
+
+    if args.plan and args.execute:
+        parser.error("--plan and --execute are mutually exclusive")
+
+    if args.ask_link and (args.plan or args.execute):
+        parser.error("--ask-link can't be used with --plan or --execute")
+
+    if (args.shard is not None) and not args.execute:
+        parser.error("--shard requires --execute")
+
     logging.basicConfig(format='[%(levelname)s] %(message)s')
     if args.verbose:
         logging.getLogger().setLevel(logging.NOTSET)
@@ -755,8 +3344,74 @@ def main():
     else:
         logging.getLogger().setLevel(logging.WARNING)
 
+    configs = []
+    for name in args.config or ['anysync.conf']:
+        if os.path.isdir(name):
+            configs.extend(sorted(os.path.join(name, filename)
+                for filename in os.listdir(name)
+                    if filename.endswith('.conf')))
+        else:
+            configs.append(name)
+
+    if not configs:
+        parser.error("no configuration files found")
+
+    metrics = AnytaskMetrics()
+
+    if len(configs) > 1:
+        if (args.ignore or args.no_ignore or args.students_list or
+                args.tasks_list or args.add_link or args.add_relocation or
+                args.remove_relocation or args.plan or args.execute or
+                args.watch):
+            parser.error("only synchronization and --update-info "
+                "support several configuration files")
+
+        try:
+            views = Anytask.load(configs, args.offline, metrics)
+        except ConfigParseError:
+            sys.exit(3)
+        except AnytaskParseError:
+            sys.exit(4)
+
+        names = [os.path.abspath(anytask.config.course_name)
+            for anytask in views]
+        if len(set(names)) != len(names):
+            logging.critical("Several configuration files share a course "
+                "directory")
+            sys.exit(3)
+
+        syncs = [AnytaskSynchronizer(anytask) for anytask in views]
+
+        try:
+            if args.update_info:
+                for sync in syncs:
+                    for solution in sync.get_updated(args):
+                        print("{}:'{}' ({})".format(
+                            solution.task.course_id, solution.task.name,
+                            solution.student.name))
+            else:
+                AnytaskSynchronizer.synchronize_all(syncs, args)
+        finally:
+            if args.metrics:
+                metrics.save(args.metrics)
+        sys.exit()
+
+    if args.execute:
+        try:
+            sync = AnytaskSynchronizer(
+                AnytaskPlan(AnytaskConfig(configs[0]), metrics), args.shard)
+            sync.execute(args)
+        except ConfigParseError:
+            sys.exit(3)
+        except AnytaskParseError:
+            sys.exit(4)
+        finally:
+            if args.metrics:
+                metrics.save(args.metrics)
+        sys.exit()
+
     try:
-        anytask = Anytask(args.config)
+        anytask = Anytask(configs[0], args.offline, metrics)
     except ConfigParseError:
         sys.exit(3)
     except AnytaskParseError:
@@ -764,18 +3419,24 @@ def main():
 
     auto_ignore = False
     if args.ignore:
-        for rb_id in args.ignore:
-            if rb_id is not None:
-                anytask.config.add_ignore(rb_id)
-            else:
-                auto_ignore = True
+        with anytask.config.transaction():
+            for rb_id in args.ignore:
+                if rb_id is not None:
+                    anytask.config.add_ignore(rb_id)
+                else:
+                    auto_ignore = True
 
     if auto_ignore and not (args.ask_link and args.force):
         parser.error("--ignore requires --ask-link and --force")
 
+    # Without a bare -i the reviews are only added to the config
+    if args.ignore and not auto_ignore:
+        sys.exit()
+
     if args.no_ignore:
-        for rb_id in args.no_ignore:
-            anytask.config.remove_ignore(rb_id)
+        with anytask.config.transaction():
+            for rb_id in args.no_ignore:
+                anytask.config.remove_ignore(rb_id)
         sys.exit()
 
     if args.students_list:
@@ -789,30 +3450,41 @@ def main():
         sys.exit()
 
     if args.add_link:
-        for link in args.add_link:
-            anytask.config.add_link(link)
+        with anytask.config.transaction():
+            for link in args.add_link:
+                anytask.config.add_link(link)
         sys.exit()
 
     if args.add_relocation:
-        for reloc in args.add_relocation:
-            anytask.config.add_reloc(reloc)
+        with anytask.config.transaction():
+            for reloc in args.add_relocation:
+                anytask.config.add_reloc(reloc)
         sys.exit()
 
     if args.remove_relocation:
-        for reloc in args.remove_relocation:
-            anytask.config.remove_reloc(reloc)
+        with anytask.config.transaction():
+            for reloc in args.remove_relocation:
+                anytask.config.remove_reloc(reloc)
         sys.exit()
 
     sync = AnytaskSynchronizer(anytask)
 
-    if args.update_info:
-        for solution in sync.get_updated(args):
-            print("{}:'{}' ({})".format(
-                solution.task.course_id, solution.task.name,
-                solution.student.name))
-        sys.exit()
-
-    sync.synchronize(args)
+    try:
+        if args.update_info:
+            for solution in sync.get_updated(args):
+                print("{}:'{}' ({})".format(
+                    solution.task.course_id, solution.task.name,
+                    solution.student.name))
+        elif args.plan:
+            if not sync.plan(args):
+                sys.exit(1)
+        elif args.watch:
+            sync.watch(args)
+        else:
+            sync.synchronize(args)
+    finally:
+        if args.metrics:
+            metrics.save(args.metrics)
 
 
 if __name__ == "__main__":